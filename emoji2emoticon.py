@@ -96,6 +96,14 @@ for k in reversed(emo):
   emo_inv[emo[k][1:-1]] = k
 
 def replace_mult(line, emo):
+  # Nothing to replace in ASCII text, in other case searching each emoji
+  # is faster than going through the characters of line in Python.
+  # The emoji are single code points, a precompiled regex (alternation or
+  # character class) with the dict as lookup was measured 4 to 25 times
+  # slower than this, mostly by the matching of each non-ASCII character
+  # and the replacement callback (tools/bench_filters.py)
+  if line.isascii():
+    return line
   for utf_emo in emo:
     if utf_emo in line:
       line = line.replace(utf_emo, emo[utf_emo])
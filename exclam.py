@@ -11,13 +11,13 @@ import os
 from telethon.tl.functions.messages import SendReactionRequest
 from telethon import types as tgty
 from telethon import utils as tgutils
-from telethon.errors.rpcerrorlist import MessageNotModifiedError, MessageAuthorRequiredError, ReactionInvalidError
+from telethon.errors.rpcerrorlist import MessageNotModifiedError, MessageAuthorRequiredError, ReactionInvalidError, MessageIdInvalidError
 
 from utils import command, HELP
 from emoji2emoticon import emo_inv
 
 class exclam(command):
-    def __init__(self, telegram):
+    def __init__(self, settings, telegram):
         self.commands = \
         { # Command         Handler                       Arguments  Min Max Maxsplit
             '!del':       (self.handle_command_del,                   1,  1, -1),
@@ -36,20 +36,29 @@ class exclam(command):
         self.tmp_ircnick = None
         self.tmp_telegram_id = None
         self.tmp_tg_msg = None
+        self.check_msgs = settings['check_messages']
 
     async def command(self, message, telegram_id, user):
         self.tmp_telegram_id = telegram_id
-        res = await self.parse_command(message, nick=None)
+        try:
+            res = await self.parse_command(message, nick=None)
+        except MessageIdInvalidError:
+            # Only possible if messages are not checked
+            res = ('{}: Unknown message'.format(message.partition(' ')[0]),)
         if isinstance(res, tuple):
             await self.irc.send_msg(self.irc.service_user, None, res[0], user)
             res = False
         return res, self.tmp_tg_msg
 
     async def check_msg(self, cid):
+        # The message is checked in the cache/store, only requested to
+        # Telegram if not there, or not checked at all if disabled
         id = self.tg.mid.id_to_num_offset(self.tmp_telegram_id, cid)
         if id is None or id < -2147483648 or id > 2147483647:
             chk_msg = None
-        else:
+        elif not self.check_msgs:
+            chk_msg = True
+        elif not (chk_msg := self.tg.from_cache(self.tmp_telegram_id, id)):
             chk_msg = await self.tg.telegram_client.get_messages(entity=self.tmp_telegram_id, ids=id)
         return id, chk_msg
 
@@ -77,9 +86,9 @@ class exclam(command):
             id, ed_msg = await self.check_msg(cid)
             if ed_msg is not None:
                 try:
-                    self.tmp_tg_msg = await self.tg.telegram_client.edit_message(ed_msg, new_msg)
+                    self.tmp_tg_msg = await self.tg.telegram_client.edit_message(self.tmp_telegram_id, id, new_msg)
                 except MessageNotModifiedError:
-                    self.tmp_tg_msg = ed_msg
+                    self.tmp_tg_msg = await self.tg.telegram_client.get_messages(entity=self.tmp_telegram_id, ids=id)
                     reply = True
                 except MessageAuthorRequiredError:
                     reply = ('!ed: Not the author of the message to edit',)
@@ -102,7 +111,7 @@ class exclam(command):
         if not help:
             id, del_msg = await self.check_msg(cid)
             if del_msg is not None:
-                deleted = await self.tg.telegram_client.delete_messages(self.tmp_telegram_id, del_msg)
+                deleted = await self.tg.telegram_client.delete_messages(self.tmp_telegram_id, id)
                 if deleted[0].pts_count == 0:
                     reply = ('!del: Not possible to delete',)
                 else:
@@ -125,13 +134,13 @@ class exclam(command):
             id, chk_msg = await self.check_msg(cid)
             if chk_msg is not None:
                 async def send_fwd(tgt_ent, id):
-                    from_ent = await self.tg.telegram_client.get_entity(self.tmp_telegram_id)
+                    from_ent = await self.tg.get_entity(self.tmp_telegram_id)
                     self.tmp_tg_msg = await self.tg.telegram_client.forward_messages(tgt_ent, id, from_ent)
                     return self.tmp_tg_msg
 
                 tgt = chat.lower()
                 if tgt in self.irc.iid_to_tid:
-                    tgt_ent = await self.tg.telegram_client.get_entity(self.irc.iid_to_tid[tgt])
+                    tgt_ent = await self.tg.get_entity(self.irc.iid_to_tid[tgt])
                     msg = await send_fwd(tgt_ent, id)
                     # echo fwded message
                     await self.tg.handle_telegram_message(event=None, message=msg)
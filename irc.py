@@ -9,20 +9,23 @@
 # Use of this source code is governed by a MIT style license that
 # can be found in the LICENSE file included in this project.
 
+import asyncio
 import collections
 import logging
-import re
+import os
 import socket
 import string
+import tempfile
 import time
 
 import tornado.ioloop
+import tornado.iostream
 
 # Local modules
 
-from include import VERSION, CHAN_MAX_LENGTH, NICK_MAX_LENGTH, MAX_LINE
+from include import VERSION, CHAN_MAX_LENGTH, NICK_MAX_LENGTH, MAX_LINE, MAX_IRC_LINE
 from irc_replies import irc_codes
-from utils import chunks, set_replace, split_lines, format_timestamp
+from utils import set_replace, split_lines, format_timestamp
 from service import service
 from exclam import exclam
 
@@ -30,32 +33,49 @@ from exclam import exclam
 
 SRV = None
 ALL_PARAMS = 16
+IRC_SUBCOMMANDS = ('CAP',)
+LONG_REPLY_LINES = 100
+ERROR_CLOSE_TIMEOUT = 10
+LIST_TOPICS_WAIT = 5
 VALID_IRC_NICK_FIRST_CHARS   = string.ascii_letters + r'[]\`_^{|}'
 VALID_IRC_NICK_CHARS         = VALID_IRC_NICK_FIRST_CHARS + string.digits + '-'
 
-# IRC Regular Expressions
-
-PREFIX          = r'(?ai)(:[^ ]+ +|)'
-IRC_CAP_LS_RX   = re.compile(PREFIX + r'CAP +(LS|LIST)( +.*)*')
-IRC_CAP_END_RX  = re.compile(PREFIX + r'CAP +(END)( +.*)*')
-IRC_CAP_REQ_RX  = re.compile(PREFIX + r'CAP +REQ( +:?(?P<extensions>[^\n]+))?')
-IRC_JOIN_RX     = re.compile(PREFIX + r'JOIN( +:| +|\n)(?P<channels>[^\n ]+|)')
-IRC_LIST_RX     = re.compile(PREFIX + r'LIST( +:| +|\n)(?P<channels>[^\n ]+|)')
-IRC_MODE_RX     = re.compile(PREFIX + r'MODE( +|\n)(?P<target>[^ ]+( +|\n)|)(?P<mode>[^ ]+( +|\n)|)(?P<arguments>[^\n]+|)')
-IRC_MOTD_RX     = re.compile(PREFIX + r'MOTD( +:| +|\n)(?P<target>[^\n ]+|)')
-IRC_NAMES_RX    = re.compile(PREFIX + r'NAMES( +:| +|\n)(?P<channels>[^\n ]+|)')
-IRC_NICK_RX     = re.compile(PREFIX + r'NICK( +:| +|\n)(?P<nick>[^\n ]+|)')
-IRC_PART_RX     = re.compile(PREFIX + r'PART( +|\n)(?P<channels>[^ ]+|)( +:| +|\n|)(?P<reason>[^\n]+|)')
-IRC_PASS_RX     = re.compile(PREFIX + r'PASS( +:| +|\n)(?P<password>[^\n ]+|)')
-IRC_PING_RX     = re.compile(PREFIX + r'PING( +:| +|\n)(?P<payload>[^\n]+|)')
-IRC_PRIVMSG_RX  = re.compile(PREFIX + r'PRIVMSG( +|\n)(?P<target>[^ ]+)( +:| +|\n)(?P<message>[^\n]+|)')
-IRC_QUIT_RX     = re.compile(PREFIX + r'QUIT( +:| +|\n)(?P<reason>[^\n]+|)')
-IRC_TOPIC_RX    = re.compile(PREFIX + r'TOPIC( +:| +|\n)(?P<channel>[^\n ]+|)')
-IRC_USER_RX     = re.compile(PREFIX + r'USER( +|\n)(?P<username>[^ ]+) +[^ ]+ +[^ ]+( +:| +|\n)(?P<realname>[^\n]+|)')
-IRC_USERHOST_RX = re.compile(PREFIX + r'USERHOST( +|\n)(?P<nick1>[^ ]+( +|\n)|)(?P<nick2>[^ ]+( +|\n)|)(?P<nick3>[^ ]+( +|\n)|)(?P<nick4>[^ ]+( +|\n)|)(?P<nick5>[^\n]+|)')
-IRC_VERSION_RX  = re.compile(PREFIX + r'VERSION( +:| +|\n)(?P<target>[^\n ]+|)')
-IRC_WHO_RX      = re.compile(PREFIX + r'WHO( +:| +|\n)(?P<target>[^\n ]+|)')
-IRC_WHOIS_RX    = re.compile(PREFIX + r'WHOIS( +:| +|\n)(?P<nicks>[^\n ]+|)')
+# IRC message parsing
+
+def parse_irc_message(line):
+    # Split a line in tags, prefix, command and parameters in one pass,
+    # the trailing parameter (starting with ':') is the last one
+    tags = {}
+    prefix = ''
+    if line[:1] == '@':
+        tag_str, _, line = line[1:].partition(' ')
+        for tag in tag_str.split(';'):
+            key, _, value = tag.partition('=')
+            tags[key] = value
+        line = line.lstrip(' ')
+    if line[:1] == ':':
+        prefix, _, line = line[1:].partition(' ')
+        line = line.lstrip(' ')
+    line, has_trailing, trailing = line.partition(' :')
+    params = line.split()
+    if has_trailing:
+        params.append(trailing)
+    command = params.pop(0).upper() if params else ''
+    return tags, prefix, command, params
+
+def get_named_params(names, params):
+    # Assign positional parameters to the names expected by the handler,
+    # a name starting with '*' takes the rest of parameters,
+    # a name None is a parameter ignored
+    named = {}
+    for n, name in enumerate(names):
+        if name is None:
+            continue
+        if name[0] == '*':
+            named[name[1:]] = ' '.join(params[n:]).strip()
+        else:
+            named[name] = params[n].strip() if n < len(params) else ''
+    return named
 
 # IRC Handler
 
@@ -72,6 +92,9 @@ class IRCHandler(object):
 
     async def run(self, stream, address):
         user = IRCUser(stream, address)
+        user.out = send_queue(user, self.conf['irc_write_buffer'], self.conf['irc_send_queue'],
+                              self.conf['irc_send_queue_policy'], os.path.expanduser(self.conf['cache_dir']),
+                              self.conf['irc_send_queue_spill'])
 
         self.logger.info('Running IRC client connection from %s:%s', address[0], address[1])
 
@@ -80,6 +103,7 @@ class IRCHandler(object):
                 message = await user.stream.read_until(b'\n')
             except tornado.iostream.StreamClosedError:
                 user.stream = None
+                user.out.close()
                 reason = user.close_reason if user.close_reason else ':Client disconnect'
                 await self.send_users_irc(user, 'QUIT', (reason,))
                 self.logger.info('Closing IRC client connection from %s:%s', address[0], address[1])
@@ -88,66 +112,71 @@ class IRCHandler(object):
                     user.del_from_channels(self)
                 del user
                 break
-            message = message.decode(self.conf['char_in_encoding'], errors='replace').replace('\r','\n')
+            message = message.decode(self.conf['char_in_encoding'], errors='replace').rstrip('\r\n')
             self.logger.debug(message)
 
-            for pattern, handler, register_required, num_params_required in self.irc_handlers:
-                matches = pattern.match(message)
-                if matches:
-                    if user.registered or not register_required:
-                        params = matches.groupdict()
-                        # Remove possible extra characters in parameters
-                        params = {x:y.strip() for x,y in params.items()}
-                        num_params = len([x for x in params.values() if x])
-                        num_params_expected = len(params.keys())
-                        if num_params >= self.num_params_necessary(num_params_required,
-                                                                   num_params_expected):
-                            await handler(user, **params)
-                        else:
-                            await self.reply_code(user, 'ERR_NEEDMOREPARAMS')
+            tags, prefix, command, params = parse_irc_message(message)
+            if not command:
+                continue
+            if command in IRC_SUBCOMMANDS and params:
+                command += ' ' + params.pop(0).upper()
+
+            if command in self.irc_handlers:
+                handler, register_required, num_params_required, names = self.irc_handlers[command]
+                if user.registered or not register_required:
+                    params = get_named_params(names, params)
+                    num_params = len([x for x in params.values() if x])
+                    num_params_expected = len(params.keys())
+                    if num_params >= self.num_params_necessary(num_params_required,
+                                                               num_params_expected):
+                        await handler(user, **params)
                     else:
-                        await self.reply_code(user, 'ERR_NOTREGISTERED', ('',), '*')
-                    break
-
-            if not matches and user.registered:
+                        await self.reply_code(user, 'ERR_NEEDMOREPARAMS')
+                else:
+                    await self.reply_code(user, 'ERR_NOTREGISTERED', ('',), '*')
+            elif user.registered:
                 await self.reply_code(user, 'ERR_UNKNOWNCOMMAND')
 
     def set_telegram(self, tg):
         self.tg = tg
         self.service = service(self.conf, self.tg)
-        self.exclam = exclam(self.tg)
+        self.exclam = exclam(self.conf, self.tg)
 
     # IRC
 
     def initialize_irc(self):
         self.irc_handlers = \
-        (
-            # pattern              handle           register_required   num_params_required
-            (IRC_CAP_LS_RX,   self.handle_irc_cap_ls,   False,            0),
-            (IRC_CAP_END_RX,  self.handle_irc_cap_end,  False,            0),
-            (IRC_CAP_REQ_RX,  self.handle_irc_cap_req,  False,            1),
-            (IRC_PRIVMSG_RX,  self.handle_irc_privmsg,  True,             ALL_PARAMS),
-            (IRC_PING_RX,     self.handle_irc_ping,     True,             ALL_PARAMS),
-            (IRC_JOIN_RX,     self.handle_irc_join,     True,             ALL_PARAMS),
-            (IRC_MODE_RX,     self.handle_irc_mode,     True,             1),
-            (IRC_NAMES_RX,    self.handle_irc_names,    True,             ALL_PARAMS),
-            (IRC_TOPIC_RX,    self.handle_irc_topic,    True,             ALL_PARAMS),
-            (IRC_USERHOST_RX, self.handle_irc_userhost, True,             1),
-            (IRC_PART_RX,     self.handle_irc_part,     True,             1),
-            (IRC_WHO_RX,      self.handle_irc_who,      True,             ALL_PARAMS),
-            (IRC_WHOIS_RX,    self.handle_irc_whois,    True,             ALL_PARAMS),
-            (IRC_LIST_RX,     self.handle_irc_list,     True,             0),
-            (IRC_NICK_RX,     self.handle_irc_nick,     False,            ALL_PARAMS),
-            (IRC_MOTD_RX,     self.handle_irc_motd,     True,             0),
-            (IRC_USER_RX,     self.handle_irc_user,     False,            ALL_PARAMS),
-            (IRC_QUIT_RX,     self.handle_irc_quit,     False,            0),
-            (IRC_VERSION_RX,  self.handle_irc_version,  True,             0),
-            (IRC_PASS_RX,     self.handle_irc_pass,     False,            ALL_PARAMS),
-        )
+        {
+            # command     handle                  register_required  num_params_required  params
+            'CAP END':   (self.handle_irc_cap_end,  False,            0,                   ()),
+            'CAP LIST':  (self.handle_irc_cap_ls,   False,            0,                   ()),
+            'CAP LS':    (self.handle_irc_cap_ls,   False,            0,                   ()),
+            'CAP REQ':   (self.handle_irc_cap_req,  False,            1,                   ('*extensions',)),
+            'JOIN':      (self.handle_irc_join,     True,             ALL_PARAMS,          ('channels',)),
+            'LIST':      (self.handle_irc_list,     True,             0,                   ('channels',)),
+            'MODE':      (self.handle_irc_mode,     True,             1,                   ('target', 'mode', '*arguments')),
+            'MOTD':      (self.handle_irc_motd,     True,             0,                   ('target',)),
+            'NAMES':     (self.handle_irc_names,    True,             ALL_PARAMS,          ('channels',)),
+            'NICK':      (self.handle_irc_nick,     False,            ALL_PARAMS,          ('nick',)),
+            'PART':      (self.handle_irc_part,     True,             1,                   ('channels', '*reason')),
+            'PASS':      (self.handle_irc_pass,     False,            ALL_PARAMS,          ('password',)),
+            'PING':      (self.handle_irc_ping,     True,             ALL_PARAMS,          ('*payload',)),
+            'PRIVMSG':   (self.handle_irc_privmsg,  True,             ALL_PARAMS,          ('target', '*message')),
+            'QUIT':      (self.handle_irc_quit,     False,            0,                   ('*reason',)),
+            'TOPIC':     (self.handle_irc_topic,    True,             ALL_PARAMS,          ('channel',)),
+            'USER':      (self.handle_irc_user,     False,            ALL_PARAMS,          ('username', None, None, '*realname')),
+            'USERHOST':  (self.handle_irc_userhost, True,             1,                   ('nick1', 'nick2', 'nick3', 'nick4', '*nick5')),
+            'VERSION':   (self.handle_irc_version,  True,             0,                   ('target',)),
+            'WHO':       (self.handle_irc_who,      True,             ALL_PARAMS,          ('target',)),
+            'WHOIS':     (self.handle_irc_whois,    True,             ALL_PARAMS,          ('nicks',)),
+        }
         self.iid_to_tid   = {}
         self.irc_channels = collections.defaultdict(set)
         self.irc_channels_ops = collections.defaultdict(set)
         self.irc_channels_founder = collections.defaultdict(set)
+        # Reverse index: nick -> channels where it is member, op or founder
+        self.irc_nick_channels = collections.defaultdict(set)
+        self.names_cache = {}
         self.start_time   = time.strftime('%a %d %b %Y %H:%M:%S %z')
         self.hist_fmt_warning = False
 
@@ -156,9 +185,12 @@ class IRCHandler(object):
         self.users[self.conf['service_user'].lower()] = self.service_user
 
     async def send_irc_command(self, user, command):
+        user.out.write(self.encode_irc_command(command))
+
+    def encode_irc_command(self, command):
         self.logger.debug('Send IRC Command: %s', command)
         command = command + '\r\n'
-        user.stream.write(command.encode(self.conf['char_out_encoding'], errors='replace'))
+        return command.encode(self.conf['char_out_encoding'], errors='replace')
 
     # IRC handlers
 
@@ -215,10 +247,7 @@ class IRCHandler(object):
                 # rename
                 await self.send_users_irc(user, 'NICK', (nick,))
                 del self.users[current]
-                for ch in self.irc_channels.keys():
-                    set_replace(self.irc_channels[ch], current, ni)
-                    set_replace(self.irc_channels_ops[ch], current, ni)
-                    set_replace(self.irc_channels_founder[ch], current, ni)
+                self.rename_channel_member(user.irc_nick, nick)
             user.irc_nick = nick
             self.users[ni] = user
             if not user.registered and user.irc_username:
@@ -258,7 +287,7 @@ class IRCHandler(object):
         self.logger.debug('Handling JOIN: %s', channels)
 
         if channels == '0':
-            for channel in self.irc_channels.keys():
+            for channel in list(self.irc_nick_channels.get(user.irc_nick, ())):
                 if user.irc_nick in self.irc_channels[channel]:
                     await self.part_irc_channel(user, channel, '')
         else:
@@ -289,14 +318,22 @@ class IRCHandler(object):
         else:
             chans = self.irc_channels.keys()
 
+        chans = [x.lower() for x in chans if x.lower() in self.irc_channels.keys()]
+        # The topics not cached (or expired) are requested in background,
+        # the ones never got are waited for a limited time
+        tasks = self.tg.refresh_channel_topics(chans)
+        cold = [ task for chan, task in tasks.items() if self.tg.get_cached_topic(chan) is None ]
+        if cold:
+            await asyncio.wait(cold, timeout=LIST_TOPICS_WAIT)
+
         await self.reply_code(user, 'RPL_LISTSTART')
-        for channel in chans:
-            chan = channel.lower()
-            if chan in self.irc_channels.keys():
-                real_chan = self.get_realcaps_name(chan)
-                users_count = len(self.irc_channels[chan])
-                topic = await self.tg.get_channel_topic(chan, [None])
-                await self.reply_code(user, 'RPL_LIST', (real_chan, users_count, topic[:MAX_LINE]))
+        for chan in chans:
+            real_chan = self.get_realcaps_name(chan)
+            users_count = len(self.irc_channels[chan])
+            topic = self.tg.get_cached_topic(chan)
+            if topic is None:
+                topic = '[Topic not available yet, repeat LIST]'
+            await self.reply_code(user, 'RPL_LIST', (real_chan, users_count, topic[:MAX_LINE]))
         await self.reply_code(user, 'RPL_LISTEND')
 
     async def handle_irc_names(self, user, channels):
@@ -346,7 +383,7 @@ class IRCHandler(object):
 
         chan = channel.lower()
         real_chan = self.get_realcaps_name(chan)
-        await self.irc_channel_topic(user, real_chan, [None])
+        await self.irc_channel_topic(user, real_chan)
 
     async def handle_irc_ping(self, user, payload):
         self.logger.debug('Handling PING: %s', payload)
@@ -365,13 +402,16 @@ class IRCHandler(object):
         else:
             await self.reply_code(user, 'ERR_NOSUCHSERVER', (target,))
             return
-        for usr in users:
+        # Copy of members, the channel can change while yielding
+        for n, usr in enumerate(list(users), start=1):
             if not isinstance(usr,IRCUser):
                 usr = self.users[usr.lower()]
             op = self.get_irc_op(usr.irc_nick, chan)
             await self.reply_code(user, 'RPL_WHOREPLY', (chan, usr.irc_username,
                 usr.address, self.gethostname(user), usr.irc_nick, op, usr.irc_realname
             ))
+            if n % LONG_REPLY_LINES == 0:
+                await user.out.drain()
         await self.reply_code(user, 'RPL_ENDOFWHO', (chan,))
 
     async def handle_irc_whois(self, user, nicks):
@@ -459,7 +499,7 @@ class IRCHandler(object):
             if cont:
                 mid = self.tg.mid.num_to_id_offset(telegram_id, tg_msg.id)
                 text = '[{}] {}'.format(mid, message)
-                self.tg.to_cache(tg_msg.id, mid, text, message, user, chan, media=None)
+                self.tg.to_cache(tg_msg.peer_id, tg_msg.id, mid, text, message, user, chan, media=None)
 
                 if defered_send:
                     await defered_send(user, defered_target, text)
@@ -471,7 +511,7 @@ class IRCHandler(object):
 
         await self.reply_command(user, SRV, 'ERROR', (':Client disconnect',))
         user.close_reason = ':' + reason
-        user.stream.close()
+        user.out.disconnect()
 
     # IRC functions
     async def register(self, user):
@@ -499,8 +539,11 @@ class IRCHandler(object):
             else:
                 irc_users = (u for u in self.users.values() if u.stream)
 
+            # Each line is rendered and encoded only once for all the users
+            # that receive the same variant of it
+            rendered = {}
             for irc_user in irc_users:
-                await self.send_privmsg(irc_user, source_mask, target, msg, timestamp=timestamp)
+                await self.send_privmsg(irc_user, source_mask, target, msg, timestamp=timestamp, rendered=rendered)
 
     async def send_msg_others(self, source, target, message):
         source_mask = source.get_irc_mask()
@@ -511,18 +554,26 @@ class IRCHandler(object):
         else:
             irc_users = (u for u in self.users.values() if u.stream and u.irc_nick != source.irc_nick)
 
+        rendered = {}
         for irc_user in irc_users:
-            await self.send_privmsg(irc_user, source_mask, target, message)
+            await self.send_privmsg(irc_user, source_mask, target, message, rendered=rendered)
 
     async def send_action(self, source, target, message, timestamp=None):
         action_message = '\x01ACTION {}{}\x01'.format(message, '{}{}')
         await self.send_msg(source, target, action_message, timestamp=timestamp)
 
-    async def send_privmsg(self, user, source_mask, target, msg, timestamp=None):
+    async def send_privmsg(self, user, source_mask, target, msg, timestamp=None, rendered=None):
         # reference [1]
         src_mask = source_mask if source_mask else user.get_irc_mask()
         # target None (False): it's private, not a channel
         tgt = target if target else user.irc_nick
+        # the only differences between users are the nick (in target, mentions
+        # and forwards) and if server-time is supported
+        variant = (src_mask, tgt, user.irc_nick, 'server-time' in user.extensions)
+        if rendered is not None and variant in rendered:
+            user.out.write(rendered[variant])
+            return
+
         if self.tg.refwd_me:
              msg = msg.format(user.irc_nick)
         # replace self @username and other mentions for self messages sent by this instance of irgramd
@@ -530,7 +581,10 @@ class IRCHandler(object):
 
         tags, msg = self.set_history_timestamp(msg, timestamp, user)
 
-        await self.send_irc_command(user, '{}:{} PRIVMSG {} :{}'.format(tags, src_mask, tgt, msg))
+        data = self.encode_irc_command('{}:{} PRIVMSG {} :{}'.format(tags, src_mask, tgt, msg))
+        if rendered is not None:
+            rendered[variant] = data
+        user.out.write(data)
 
     async def reply_command(self, user, prfx, comm, params):
         prefix = self.gethostname(user) if prfx == SRV else prfx.get_irc_mask()
@@ -639,11 +693,10 @@ class IRCHandler(object):
             await self.reply_code(user, 'RPL_CHANNELMODEIS', (channel, modes,''))
 
     async def join_irc_channel(self, user, channel, full_join):
-        entity_cache = [None]
         chan = channel.lower()
         real_chan = self.get_realcaps_name(chan)
 
-        if full_join: self.irc_channels[chan].add(user.irc_nick)
+        if full_join: self.add_channel_member(chan, user.irc_nick)
 
         # Notify IRC users in this channel
         for usr in [self.users[x.lower()] for x in self.irc_channels[chan] if self.users[x.lower()].stream]:
@@ -653,12 +706,12 @@ class IRCHandler(object):
             return
 
         op = self.get_irc_op(self.tg.tg_username, channel)
-        if op == '@': self.irc_channels_ops[chan].add(user.irc_nick)
-        elif op == '~': self.irc_channels_founder[chan].add(user.irc_nick)
+        if op == '@': self.add_channel_op(chan, user.irc_nick)
+        elif op == '~': self.add_channel_founder(chan, user.irc_nick)
 
-        date = await self.tg.get_channel_creation(channel, entity_cache)
+        date = await self.tg.get_channel_creation(channel)
         await self.reply_code(user, 'RPL_CREATIONTIME', (real_chan, date))
-        await self.irc_channel_topic(user, real_chan, entity_cache)
+        await self.irc_channel_topic(user, real_chan)
         await self.irc_namelist(user, real_chan)
 
     async def part_irc_channel(self, user, channel, reason):
@@ -669,14 +722,12 @@ class IRCHandler(object):
         for usr in [self.users[x.lower()] for x in self.irc_channels[chan] if self.users[x.lower()].stream]:
             await self.reply_command(usr, user, 'PART', (real_chan, reason))
 
-        self.irc_channels[chan].remove(user.irc_nick)
-        self.irc_channels_ops[chan].discard(user.irc_nick)
-        self.irc_channels_founder[chan].discard(user.irc_nick)
+        self.del_channel_member(chan, user.irc_nick)
 
-    async def irc_channel_topic(self, user, channel, entity_cache):
+    async def irc_channel_topic(self, user, channel):
         chan = channel.lower()
-        topic = await self.tg.get_channel_topic(chan, entity_cache)
-        timestamp = await self.tg.get_channel_creation(chan, entity_cache)
+        topic = await self.tg.get_channel_topic(chan)
+        timestamp = await self.tg.get_channel_creation(chan)
         if self.irc_channels_founder[chan]:
             founder = list(self.irc_channels_founder[chan])[0]
         else:
@@ -685,12 +736,42 @@ class IRCHandler(object):
         await self.reply_code(user, 'RPL_TOPICWHOTIME', (channel, founder, timestamp))
 
     async def irc_namelist(self, user, channel):
-        nicks = [self.get_irc_op(x, channel) + x for x in self.irc_channels[channel.lower()]]
         status = '='
-        for chunk in chunks(nicks, 25, ''):
-            await self.reply_code(user, 'RPL_NAMREPLY', (status, channel, ' '.join(chunk)))
+        num, _ = irc_codes['RPL_NAMREPLY']
+        head = ':{} {} {} {} {} :'.format(self.gethostname(user), num, user.irc_nick, status, channel)
+        width = MAX_IRC_LINE - 2 - len(head.encode(self.conf['char_out_encoding'], errors='replace'))
+        for n, names in enumerate(self.get_names_lines(channel.lower(), width), start=1):
+            await self.reply_code(user, 'RPL_NAMREPLY', (status, channel, names))
+            if n % LONG_REPLY_LINES == 0:
+                await user.out.drain()
         await self.reply_code(user, 'RPL_ENDOFNAMES', (channel,))
 
+    def get_names_lines(self, chan, width):
+        # Nicks of the channel (with op/founder prefix) packed in lines of
+        # up to width bytes, cached until the membership of the channel changes
+        cache = self.names_cache.setdefault(chan, {})
+        if width not in cache:
+            enc = self.conf['char_out_encoding']
+            lines = []
+            line = ''
+            length = 0
+            for nick in self.irc_channels[chan]:
+                name = self.get_irc_op(nick, chan) + nick
+                name_length = len(name.encode(enc, errors='replace'))
+                if line and length + 1 + name_length > width:
+                    lines.append(line)
+                    line = ''
+                if line:
+                    line += ' ' + name
+                    length += 1 + name_length
+                else:
+                    line = name
+                    length = name_length
+            if line:
+                lines.append(line)
+            cache[width] = lines
+        return cache[width]
+
     def get_irc_op(self, nick, channel):
         chan = channel.lower()
         if chan in self.irc_channels.keys():
@@ -700,6 +781,61 @@ class IRCHandler(object):
                 return '~'
         return ''
 
+    # Channel membership is kept by channel (irc_channels, irc_channels_ops,
+    # irc_channels_founder) and by nick (irc_nick_channels), both must be
+    # modified only with the following methods
+
+    def add_channel_member(self, chan, nick):
+        self.names_cache.pop(chan, None)
+        self.irc_channels[chan].add(nick)
+        self.irc_nick_channels[nick].add(chan)
+
+    def add_channel_op(self, chan, nick):
+        self.names_cache.pop(chan, None)
+        self.irc_channels_ops[chan].add(nick)
+        self.irc_nick_channels[nick].add(chan)
+
+    def add_channel_founder(self, chan, nick):
+        self.names_cache.pop(chan, None)
+        self.irc_channels_founder[chan].add(nick)
+        self.irc_nick_channels[nick].add(chan)
+
+    def del_channel_op(self, chan, nick):
+        self.names_cache.pop(chan, None)
+        self.irc_channels_ops[chan].discard(nick)
+        self.unindex_channel_member(chan, nick)
+
+    def del_channel_founder(self, chan, nick):
+        self.names_cache.pop(chan, None)
+        self.irc_channels_founder[chan].discard(nick)
+        self.unindex_channel_member(chan, nick)
+
+    def del_channel_member(self, chan, nick):
+        self.names_cache.pop(chan, None)
+        self.irc_channels[chan].discard(nick)
+        self.irc_channels_ops[chan].discard(nick)
+        self.irc_channels_founder[chan].discard(nick)
+        self.unindex_channel_member(chan, nick)
+
+    def unindex_channel_member(self, chan, nick):
+        # Only if not in the channel by any of the sets
+        if nick in self.irc_channels[chan] or nick in self.irc_channels_ops[chan] or \
+           nick in self.irc_channels_founder[chan]:
+            return
+        chans = self.irc_nick_channels.get(nick)
+        if chans is not None:
+            chans.discard(chan)
+            if not chans:
+                del self.irc_nick_channels[nick]
+
+    def rename_channel_member(self, nick, new_nick):
+        for chan in self.irc_nick_channels.pop(nick, ()):
+            self.names_cache.pop(chan, None)
+            set_replace(self.irc_channels[chan], nick, new_nick)
+            set_replace(self.irc_channels_ops[chan], nick, new_nick)
+            set_replace(self.irc_channels_founder[chan], nick, new_nick)
+            self.irc_nick_channels[new_nick].add(chan)
+
     def get_realcaps_name(self, name):
         # name must be in lower
         return self.tg.tid_to_iid[self.iid_to_tid[name]]
@@ -737,17 +873,17 @@ class IRCUser(object):
         self.recv_pass = ''
         self.oper = False
         self.tls = False
-        self.bot = None
         self.is_service = is_service
         self.close_reason = ''
         self.extensions = []
+        self.out = None
 
     def get_irc_mask(self):
         return '{}!{}@{}'.format(self.irc_nick, self.irc_username, self.address)
 
     def get_channels(self, irc):
         res = ''
-        for chan in irc.irc_channels.keys():
+        for chan in irc.irc_nick_channels.get(self.irc_nick, ()):
             if self.irc_nick in irc.irc_channels[chan]:
                 res += irc.get_irc_op(self.irc_nick, chan) + chan + ' '
         return res
@@ -761,10 +897,8 @@ class IRCUser(object):
         else: return False
 
     def del_from_channels(self, irc, channels=None):
-        for chan in channels if channels else irc.irc_channels.keys():
-            irc.irc_channels[chan].discard(self.irc_nick)
-            irc.irc_channels_ops[chan].discard(self.irc_nick)
-            irc.irc_channels_founder[chan].discard(self.irc_nick)
+        for chan in channels if channels else list(irc.irc_nick_channels.get(self.irc_nick, ())):
+            irc.del_channel_member(chan, self.irc_nick)
 
     def pam_auth(self, nick, pam, pam_group, recv_pass):
         if not pam: return False
@@ -807,3 +941,159 @@ class IRCUser(object):
                  and nick in nicks
                  and recv_pass == irc_pass
                )
+
+class send_queue:
+    # Output of a connected IRC user, lines are collected during the current
+    # iteration of the loop and written together, only one write is pending
+    # in the stream at a time, so a slow client accumulates the output here,
+    # up to max_size bytes (0 for no limit), over that the policy is applied:
+    #   drop: discard the oldest lines
+    #   disconnect: close the connection with an ERROR
+    #   spill: continue queuing in a temporary file, up to spill_max bytes
+    #          (0 for no limit), then disconnect
+    def __init__(self, user, high_water, max_size, policy, spill_dir, spill_max):
+        self.logger = logging.getLogger()
+        self.user = user
+        self.high_water = high_water
+        self.max_size = max_size
+        self.policy = policy if policy in ('drop', 'disconnect', 'spill') else 'disconnect'
+        self.spill_dir = spill_dir
+        self.spill_max = spill_max
+        self.queue = collections.deque()
+        self.size = 0
+        self.dropped = 0
+        self.writing = False
+        self.flush_scheduled = False
+        self.closed = False
+        self.drained = asyncio.Event()
+        self.spill = None
+        self.spill_write_pos = 0
+        self.spill_read_pos = 0
+
+    def write(self, data):
+        if self.closed or not self.user.stream:
+            return
+        if self.spill:
+            if self.spill_max and self.spill_write_pos - self.spill_read_pos + len(data) > self.spill_max:
+                self.overflow_disconnect()
+                return
+            self.spill.seek(self.spill_write_pos)
+            self.spill.write(data)
+            self.spill_write_pos += len(data)
+        elif not self.max_size or self.size + len(data) <= self.max_size or self.overflow(data):
+            self.queue.append(data)
+            self.size += len(data)
+
+        if self.size >= self.high_water:
+            self.flush()
+        elif not self.flush_scheduled:
+            self.flush_scheduled = True
+            tornado.ioloop.IOLoop.current().add_callback(self.flush)
+
+    def overflow(self, data):
+        # Return True if data must be added to the queue
+        if self.policy == 'drop':
+            while self.queue and self.size + len(data) > self.max_size:
+                self.size -= len(self.queue.popleft())
+                self.dropped += 1
+            if self.dropped == 1 or self.dropped % 1000 == 0:
+                self.logger.warning('Send queue of "%s" full, %s lines dropped', self.user.irc_nick, self.dropped)
+            return True
+        elif self.policy == 'spill':
+            os.makedirs(self.spill_dir, exist_ok=True)
+            self.spill = tempfile.TemporaryFile(dir=self.spill_dir, prefix='irgramd-sendq-')
+            self.spill.write(data)
+            self.spill_write_pos = len(data)
+            self.spill_read_pos = 0
+            self.logger.info('Send queue of "%s" full, spilling to disk', self.user.irc_nick)
+            return False
+        else: # disconnect
+            self.overflow_disconnect()
+            return False
+
+    def overflow_disconnect(self):
+        self.logger.warning('Send queue of "%s" full, disconnecting', self.user.irc_nick)
+        self.user.close_reason = ':Send queue exceeded'
+        self.queue.clear()
+        self.size = 0
+        self.disconnect(b'ERROR :Closing link (Send queue exceeded)\r\n')
+
+    def disconnect(self, error=b''):
+        # The queue (not spilled output) and error are written and the
+        # connection closed when done, or anyway after a while, as the client
+        # may not be reading
+        data = b''.join(self.queue) + error
+        self.close()
+        stream = self.user.stream
+        try:
+            future = stream.write(data)
+        except tornado.iostream.StreamClosedError:
+            return
+        handle = tornado.ioloop.IOLoop.current().call_later(ERROR_CLOSE_TIMEOUT, stream.close)
+        def written(future):
+            future.exception()
+            tornado.ioloop.IOLoop.current().remove_timeout(handle)
+            stream.close()
+        future.add_done_callback(written)
+
+    def unspill(self):
+        self.spill.seek(self.spill_read_pos)
+        data = self.spill.read(max(self.high_water, self.max_size // 2))
+        self.spill_read_pos += len(data)
+        if self.spill_read_pos >= self.spill_write_pos:
+            self.spill.close()
+            self.spill = None
+        if data:
+            self.queue.append(data)
+            self.size += len(data)
+
+    def flush(self, force=False):
+        self.flush_scheduled = False
+        if self.closed or not self.user.stream or (self.writing and not force):
+            return
+        if not self.queue and self.spill:
+            self.unspill()
+        if not self.queue:
+            return
+        data = b''.join(self.queue)
+        self.queue.clear()
+        self.size = 0
+        try:
+            future = self.user.stream.write(data)
+        except tornado.iostream.StreamClosedError:
+            return
+        self.writing = True
+        future.add_done_callback(self.write_done)
+
+    def write_done(self, future):
+        self.writing = False
+        if future.exception() is None and (self.queue or self.spill):
+            self.flush()
+        self.drained.set()
+
+    async def drain(self):
+        # Yield to other tasks and wait until at least half of the queue
+        # has been written, used by long replies to not fill the queue
+        await asyncio.sleep(0)
+        while not self.closed and self.max_size and self.pending() > self.max_size // 2:
+            self.drained.clear()
+            await self.drained.wait()
+
+    def pending(self):
+        if self.spill:
+            return self.size + self.spill_write_pos - self.spill_read_pos
+        else:
+            return self.size
+
+    def close(self):
+        self.closed = True
+        self.drained.set()
+        self.queue.clear()
+        self.size = 0
+        if self.spill:
+            self.spill.close()
+            self.spill = None
+
+    def fill(self):
+        # Percentage of the queue in use, over 100 when spilled to disk
+        return self.pending() * 100 // self.max_size if self.max_size else 0
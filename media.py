@@ -0,0 +1,491 @@
+# irgramd: IRC-Telegram gateway
+# media.py: Management of Telegram media downloads
+#
+# Copyright (c) 2026 E. Bosch <presidev@AT@gmail.com>
+#
+# Use of this source code is governed by a MIT style license that
+# can be found in the LICENSE file included in this project.
+
+import asyncio
+import collections
+import email.utils
+import glob
+import heapq
+import itertools
+import logging
+import mimetypes
+import os
+import re
+import time
+import urllib.parse
+
+from utils import get_human_size
+
+# Seconds between checks of the media cache limits
+
+EVICT_INTERVAL = 60
+
+# Large files are downloaded in parts of the maximum size of a Telegram file
+# request, several at the same time
+
+PART_SIZE = 524288
+PARTS_MIN_SIZE = 4 * PART_SIZE
+
+# Partial downloads not continued in this time are removed (at start and
+# with the checks of the media cache limits)
+
+PART_MAX_AGE = 86400
+PART_NAME = re.compile(r'( \(\d+\))?\.part(\.parts)?$')
+
+# Limits for the HTTP requests of the media server
+
+HTTP_HEADER_MAX = 16384
+HTTP_IDLE_TIMEOUT = 60
+
+HTTP_REASONS = {
+                 200: 'OK',
+                 206: 'Partial Content',
+                 304: 'Not Modified',
+                 400: 'Bad Request',
+                 404: 'Not Found',
+                 405: 'Method Not Allowed',
+                 416: 'Range Not Satisfiable',
+                 502: 'Bad Gateway',
+               }
+
+RANGE = re.compile(r'bytes=(\d*)-(\d*)$')
+
+class download_queue:
+    # Downloads run in background, at most "parallel" at the same time and
+    # "parallel_chat" of the same chat, the smallest first. A download
+    # already queued or running with the same key is not repeated, the
+    # future of the first one is returned
+    def __init__(self, parallel, parallel_chat):
+        self.logger = logging.getLogger()
+        self.parallel = parallel
+        self.parallel_chat = parallel_chat
+        self.pending = []
+        self.futures = {}
+        self.running = 0
+        self.running_chat = collections.Counter()
+        self.seq = itertools.count()
+        # References to the running tasks, the loop only keeps weak ones
+        self.tasks = set()
+
+    def add(self, key, chat, size, func, *args):
+        if key in self.futures:
+            return self.futures[key]
+        future = asyncio.get_event_loop().create_future()
+        self.futures[key] = future
+        # seq keeps the order of arrival for the same size (and func, args
+        # are never compared)
+        heapq.heappush(self.pending, (size, next(self.seq), key, chat, func, args))
+        self.start()
+        return future
+
+    def start(self):
+        skipped = []
+        while self.pending and self.running < self.parallel:
+            item = heapq.heappop(self.pending)
+            chat = item[3]
+            if self.running_chat[chat] >= self.parallel_chat:
+                skipped.append(item)
+                continue
+            self.running += 1
+            self.running_chat[chat] += 1
+            task = asyncio.create_task(self.run(*item))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+        for item in skipped:
+            heapq.heappush(self.pending, item)
+
+    async def run(self, size, seq, key, chat, func, args):
+        # The future is always resolved: the result (None if failed) or
+        # cancelled if the download is cancelled. It can be already
+        # cancelled by a waiter, then the result is discarded
+        future = self.futures[key]
+        try:
+            try:
+                result = await func(*args)
+            except Exception as err:
+                self.logger.warning('Download of %s failed: %s', key, repr(err))
+                result = None
+            if not future.done():
+                future.set_result(result)
+        finally:
+            if not future.done():
+                future.cancel()
+            self.running -= 1
+            self.running_chat[chat] -= 1
+            if not self.running_chat[chat]:
+                del self.running_chat[chat]
+            del self.futures[key]
+            self.start()
+
+class part_file:
+    # File downloaded in parts of PART_SIZE in any order, preallocated with
+    # its final size. The parts completed are recorded in "path.parts" (a
+    # byte per part), so an interrupted download is resumed with the
+    # "missing" parts
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+        count = (size + PART_SIZE - 1) // PART_SIZE
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        self.parts_fd = os.open(path + '.parts', os.O_RDWR | os.O_CREAT, 0o644)
+        done = os.pread(self.parts_fd, count, 0)
+        if len(done) != count or os.fstat(self.fd).st_size != size:
+            # New or not from a download in parts of the same file
+            done = bytes(count)
+            os.ftruncate(self.parts_fd, 0)
+            os.pwrite(self.parts_fd, done, 0)
+            os.ftruncate(self.fd, size)
+            if hasattr(os, 'posix_fallocate'):
+                try:
+                    os.posix_fallocate(self.fd, 0, size)
+                except OSError:
+                    pass
+        self.missing = [index for index in range(count) if not done[index]]
+        self.pending = set(self.missing)
+
+    def write(self, index, data):
+        offset = index * PART_SIZE
+        if len(data) != min(PART_SIZE, self.size - offset):
+            raise ValueError('Part {} of {} with wrong size {}'.format(index, self.path, len(data)))
+        os.pwrite(self.fd, data, offset)
+        os.pwrite(self.parts_fd, b'\1', index)
+        self.pending.discard(index)
+
+    def close(self):
+        os.close(self.fd)
+        os.close(self.parts_fd)
+
+    def finish(self):
+        self.close()
+        if self.pending:
+            raise ValueError('{} parts of {} not downloaded'.format(len(self.pending), self.path))
+        os.remove(self.path + '.parts')
+
+class media_cache:
+    # Index of the files in the media directory: size, last access and the
+    # per-message links of the files in the content store. Used to remove
+    # the least recently used files when over quota (bytes) or older than
+    # max_days without scanning the directory again (only at start).
+    # Partial downloads (in progress or interrupted, to be resumed) are not
+    # counted for the quota, they are removed if not continued in
+    # PART_MAX_AGE
+    def __init__(self, media_dir, store_dir, quota, max_days):
+        self.logger = logging.getLogger()
+        self.media_dir = media_dir
+        self.store_dir = store_dir
+        self.quota = quota
+        self.max_days = max_days
+        self.enabled = bool(quota or max_days)
+        # path -> [size, last access, set of links], least recently used first
+        self.files = collections.OrderedDict()
+        # link -> path in store
+        self.links = {}
+        self.total = 0
+        # path of partial download -> [size, last start]
+        self.partial = {}
+        self.partial_total = 0
+
+    def scan(self):
+        # Run in a thread, the index is only modified by the caller
+        files = {}
+        links = {}
+        stores = {}
+        partial = {}
+        stale = time.time() - PART_MAX_AGE
+        for entry in os.scandir(self.store_dir):
+            if not entry.is_file():
+                continue
+            st = entry.stat()
+            if entry.name.endswith(('.part', '.parts')):
+                self.scan_partial(entry.path, st, stale, partial)
+            else:
+                stores[(st.st_dev, st.st_ino)] = entry.path
+                files[entry.path] = [st.st_size, max(st.st_atime, st.st_mtime), set()]
+        for entry in os.scandir(self.media_dir):
+            if entry.name.endswith(('.part', '.parts')) and entry.is_file(follow_symlinks=False):
+                # Downloaded before the content store
+                self.scan_partial(entry.path, entry.stat(), stale, partial)
+            elif entry.is_symlink():
+                store_path = os.path.join(self.media_dir, os.readlink(entry.path))
+            elif entry.is_file():
+                st = entry.stat()
+                store_path = stores.get((st.st_dev, st.st_ino))
+                if not store_path:
+                    # Downloaded before the content store
+                    files[entry.path] = [st.st_size, max(st.st_atime, st.st_mtime), set()]
+            else:
+                continue
+            if store_path in files:
+                files[store_path][2].add(entry.path)
+                links[entry.path] = store_path
+        return files, links, partial
+
+    def scan_partial(self, path, st, stale, partial):
+        if st.st_mtime < stale:
+            try:
+                os.remove(path)
+                self.logger.info('Media cache: stale partial download %s removed', path)
+            except OSError as err:
+                self.logger.warning('Media cache: not possible to remove %s: %s', path, repr(err))
+        else:
+            # By the name of the download (without ".parts" or " (N)")
+            name = PART_NAME.sub('.part', path)
+            partial[name] = partial.get(name, 0) + st.st_size
+
+    def load(self, files, links, partial):
+        # Least recently used first, the files added while scanning are newer
+        current = self.files
+        self.files = collections.OrderedDict(sorted(files.items(), key=lambda x: x[1][1]))
+        self.total = sum(x[0] for x in self.files.values())
+        self.links.update(links)
+        for path, (size, last, path_links) in current.items():
+            self.add(path, size, last)
+            for link in path_links:
+                self.add_link(path, link)
+        for path, size in partial.items():
+            if path not in self.partial:
+                self.add_partial(path, size)
+        self.logger.info('Media cache: %s files, %s, partial downloads %s', len(self.files),
+                         get_human_size(self.total), get_human_size(self.partial_total))
+
+    def add(self, path, size, last=None):
+        if not self.enabled:
+            return
+        if path in self.files:
+            self.total -= self.files[path][0]
+            links = self.files[path][2]
+        else:
+            links = set()
+        self.files[path] = [size, last or time.time(), links]
+        self.files.move_to_end(path)
+        self.total += size
+
+    def add_link(self, path, link):
+        if self.enabled and path in self.files:
+            self.files[path][2].add(link)
+            self.links[link] = path
+
+    def add_partial(self, path, size):
+        if self.enabled:
+            self.del_partial(path)
+            self.partial[path] = [size, time.time()]
+            self.partial_total += size
+
+    def del_partial(self, path, remove=False):
+        # With remove the files of the partial download are also removed:
+        # the data, the record of parts and variants of the name
+        self.partial_total -= self.partial.pop(path, (0,))[0]
+        if remove:
+            for file in [path, path + '.parts'] + glob.glob(glob.escape(path[:-len('.part')]) + ' (*).part'):
+                try:
+                    os.remove(file)
+                except FileNotFoundError:
+                    pass
+                except OSError as err:
+                    self.logger.warning('Media cache: not possible to remove %s: %s', file, repr(err))
+
+    def touch(self, path):
+        path = self.links.get(path, path)
+        if path in self.files:
+            self.files[path][1] = time.time()
+            self.files.move_to_end(path)
+
+    def evict(self):
+        limit = time.time() - self.max_days * 86400 if self.max_days else 0
+        count = 0
+        while self.files:
+            path, (size, last, links) = next(iter(self.files.items()))
+            if last >= limit and (not self.quota or self.total <= self.quota):
+                break
+            del self.files[path]
+            self.total -= size
+            for file in links | {path}:
+                self.links.pop(file, None)
+                try:
+                    os.remove(file)
+                except FileNotFoundError:
+                    pass
+                except OSError as err:
+                    self.logger.warning('Media cache: not possible to remove %s: %s', file, repr(err))
+            count += 1
+        if count:
+            self.logger.info('Media cache: %s files removed, %s in use', count, get_human_size(self.total))
+
+    def expire_partial(self):
+        # Interrupted downloads not resumed, the ones in progress are written
+        # or were started recently
+        stale = time.time() - PART_MAX_AGE
+        for path, (size, start) in list(self.partial.items()):
+            if start >= stale:
+                continue
+            try:
+                mtime = os.stat(path).st_mtime
+            except OSError:
+                mtime = 0
+            if mtime < stale:
+                self.del_partial(path, remove=True)
+                self.logger.info('Media cache: stale partial download %s removed', path)
+
+    async def run(self):
+        self.load(*await asyncio.to_thread(self.scan))
+        while True:
+            self.evict()
+            self.expire_partial()
+            await asyncio.sleep(EVICT_INTERVAL)
+
+class media_server:
+    # Minimal HTTP/1.1 server for the files in the media directory, running
+    # on the same loop. Only GET and HEAD of names in the top of the
+    # directory (the content store and partial downloads are hidden), with
+    # single byte ranges, ETag/Last-Modified conditional requests and
+    # persistent connections. The body is sent with sendfile() if the
+    # platform has it. Files not present are requested to fetch(name)
+    # (if set), that returns when they are available or not possible
+    def __init__(self, media_dir, cache, address, port, fetch=None):
+        self.logger = logging.getLogger()
+        self.media_dir = media_dir
+        self.cache = cache
+        self.fetch = fetch
+        self.address = address
+        self.port = port
+        self.server = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, self.address, self.port, limit=HTTP_HEADER_MAX)
+        self.logger.info('Media server listening on %s:%s', self.address, self.port)
+
+    async def handle(self, reader, writer):
+        try:
+            while await self.request(reader, writer):
+                pass
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError,
+                ConnectionError, ValueError):
+            pass
+        except Exception as err:
+            self.logger.warning('Media server: error in request: %s', repr(err))
+        finally:
+            writer.close()
+
+    async def request(self, reader, writer):
+        # Returns if the connection can be reused
+        head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), HTTP_IDLE_TIMEOUT)
+        lines = head.decode('latin-1').split('\r\n')
+        try:
+            method, target, version = lines[0].split(' ')
+        except ValueError:
+            await self.respond(writer, 400, None, False, False)
+            return False
+        headers = {}
+        for line in lines[1:]:
+            name, sep, value = line.partition(':')
+            if sep:
+                headers[name.strip().lower()] = value.strip()
+        keep = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+        head = method == 'HEAD'
+
+        if method not in ('GET', 'HEAD'):
+            await self.respond(writer, 405, { 'Allow': 'GET, HEAD' }, keep, head)
+            return keep
+        name = urllib.parse.unquote(urllib.parse.urlsplit(target).path.rpartition('/')[2])
+        path = os.path.join(self.media_dir, name)
+        if not name or name[0] == '.' or '/' in name:
+            await self.respond(writer, 404, None, keep, head)
+            return keep
+        if not os.path.isfile(path):
+            try:
+                found = self.fetch and await self.fetch(name)
+            except Exception as err:
+                self.logger.warning('Media server: not possible to get %s: %s', name, repr(err))
+                await self.respond(writer, 502, None, keep, head)
+                return keep
+            if not found:
+                await self.respond(writer, 404, None, keep, head)
+                return keep
+        self.cache.touch(path)
+
+        with open(path, 'rb') as file:
+            st = os.fstat(file.fileno())
+            size = st.st_size
+            etag = '"{:x}-{:x}"'.format(st.st_mtime_ns, size)
+            headers_out = {
+                            'Accept-Ranges': 'bytes',
+                            'ETag': etag,
+                            'Last-Modified': email.utils.formatdate(st.st_mtime, usegmt=True),
+                            'Content-Type': mimetypes.guess_type(name)[0] or 'application/octet-stream',
+                          }
+            if self.not_modified(headers, etag, st.st_mtime):
+                await self.respond(writer, 304, headers_out, keep, head)
+                return keep
+
+            start, end = 0, size
+            status = 200
+            ranges = headers.get('range')
+            match = RANGE.match(ranges.replace(' ', '')) if ranges and headers.get('if-range', etag) == etag else None
+            # Only one range, if not valid it's ignored and the whole file is
+            # sent (RFC 9110), 416 only for a valid range out of the file
+            if match and match.group(1):
+                first = int(match.group(1))
+                last = int(match.group(2)) if match.group(2) else None
+                if last is not None and last < first:
+                    match = None
+                elif first >= size:
+                    start = end = None
+                else:
+                    start, end = first, size if last is None else min(last + 1, size)
+            elif match and match.group(2):
+                suffix = int(match.group(2))
+                if suffix and size:
+                    start = max(size - suffix, 0)
+                else:
+                    start = end = None
+            else:
+                match = None
+            if match and start is None:
+                headers_out['Content-Range'] = 'bytes */{}'.format(size)
+                await self.respond(writer, 416, headers_out, keep, head)
+                return keep
+            if match:
+                status = 206
+                headers_out['Content-Range'] = 'bytes {}-{}/{}'.format(start, end - 1, size)
+
+            headers_out['Content-Length'] = end - start
+            await self.respond(writer, status, headers_out, keep, head)
+            if not head and end > start:
+                await asyncio.get_event_loop().sendfile(writer.transport, file, start, end - start)
+        return keep
+
+    @staticmethod
+    def not_modified(headers, etag, mtime):
+        if 'if-none-match' in headers:
+            tags = [tag.strip() for tag in headers['if-none-match'].split(',')]
+            return '*' in tags or etag in tags or 'W/' + etag in tags
+        if 'if-modified-since' in headers:
+            try:
+                since = email.utils.parsedate_to_datetime(headers['if-modified-since']).timestamp()
+            except (TypeError, ValueError):
+                return False
+            return int(mtime) <= since
+        return False
+
+    async def respond(self, writer, status, headers, keep, head):
+        # Status line and headers, the body of errors is the reason
+        lines = [ 'HTTP/1.1 {} {}'.format(status, HTTP_REASONS[status]),
+                  'Date: {}'.format(email.utils.formatdate(usegmt=True)),
+                  'Server: irgramd',
+                ]
+        headers = headers or {}
+        body = b''
+        if status >= 400:
+            body = '{} {}\n'.format(status, HTTP_REASONS[status]).encode()
+            headers['Content-Type'] = 'text/plain'
+            headers['Content-Length'] = len(body)
+        if not keep:
+            headers['Connection'] = 'close'
+        lines.extend('{}: {}'.format(name, value) for name, value in headers.items())
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + (b'' if head else body))
+        await writer.drain()
@@ -0,0 +1,250 @@
+# irgramd: IRC-Telegram gateway
+# store.py: Persistent store of messages relayed from/to Telegram
+#
+# Copyright (c) 2026 E. Bosch <presidev@AT@gmail.com>
+#
+# Use of this source code is governed by a MIT style license that
+# can be found in the LICENSE file included in this project.
+
+import asyncio
+import collections
+import datetime
+import hashlib
+import logging
+import sqlite3
+import sys
+import time
+
+# Seconds between commits of pending writes and between retention passes
+
+COMMIT_DELAY = 1
+PRUNE_INTERVAL = 3600
+
+# Rows removed at a time by the retention, to not block the loop for long
+
+PRUNE_BATCH = 1000
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS messages (
+    peer INTEGER NOT NULL,
+    id INTEGER NOT NULL,
+    is_channel INTEGER NOT NULL,
+    mid TEXT,
+    text TEXT,
+    rendered_text TEXT,
+    user TEXT,
+    channel TEXT,
+    media BLOB,
+    date REAL NOT NULL,
+    UNIQUE (peer, id)
+);
+CREATE INDEX IF NOT EXISTS messages_id ON messages (id) WHERE is_channel = 0;
+CREATE INDEX IF NOT EXISTS messages_date ON messages (date);
+CREATE TABLE IF NOT EXISTS events (
+    peer INTEGER NOT NULL,
+    prev_id INTEGER NOT NULL,
+    id INTEGER NOT NULL,
+    rendered_event TEXT,
+    user TEXT,
+    channel TEXT,
+    date REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS events_prev ON events (peer, prev_id);
+CREATE INDEX IF NOT EXISTS events_date ON events (date);
+CREATE TABLE IF NOT EXISTS mesg_base (
+    peer INTEGER PRIMARY KEY,
+    base INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS media (
+    name TEXT PRIMARY KEY,
+    peer INTEGER NOT NULL,
+    id INTEGER NOT NULL,
+    store TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    date REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS media_date ON media (date);
+'''
+
+MESSAGE_FIELDS = ('mid', 'text', 'rendered_text', 'user', 'channel', 'media')
+
+# Approximate memory of an entry in the LRU (OrderedDict node and key tuple),
+# not counting the record
+
+ENTRY_OVERHEAD = 200
+
+def media_digest(media):
+    # Media is only compared (to detect editions), a digest of its
+    # serialization is enough and can be stored
+    if media is None:
+        return None
+    return hashlib.blake2b(bytes(media), digest_size=16).digest()
+
+class cached_message:
+    # Compact record of a message, "size" is the approximate memory used by
+    # the record with its values
+    __slots__ = MESSAGE_FIELDS + ('size',)
+
+    def __init__(self, mid, text, rendered_text, user, channel, media):
+        self.mid = mid
+        self.text = text
+        self.rendered_text = rendered_text
+        self.user = user
+        self.channel = channel
+        self.media = media
+        self.size = ENTRY_OVERHEAD + sys.getsizeof(self) + \
+                    sum(sys.getsizeof(x) for x in (mid, text, rendered_text, user, channel, media) if x is not None)
+
+    def values(self):
+        return (self.mid, self.text, self.rendered_text, self.user, self.channel, self.media)
+
+class message_store:
+    # Messages by (peer id, message id) in a SQLite database, the most
+    # recently used are also kept in memory (as cached_message records) up to
+    # a budget of hot_bytes. "user" is stored as IRC nick
+    # (None for the self Telegram user) and "media" as media_digest().
+    # Events (editions, reactions, deletions) are stored by peer and the id
+    # of the previous message in it, to be shown in history.
+    # Media descriptors (the message of a file name in the media directory)
+    # allow to download files when requested
+    def __init__(self, path, hot_bytes, max_messages, max_days):
+        self.logger = logging.getLogger()
+        self.hot = collections.OrderedDict()
+        self.hot_bytes = hot_bytes
+        self.hot_used = 0
+        self.max_messages = max_messages
+        self.max_days = max_days
+        self.db = sqlite3.connect(path)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.executescript(SCHEMA)
+        self.commit_handle = None
+        self.last_prune = 0
+        self.prune_task = None
+
+    def put(self, peer, id, is_channel, record):
+        self.to_hot((peer, id), record)
+        self.db.execute('INSERT OR REPLACE INTO messages VALUES (?,?,?,?,?,?,?,?,?,?)',
+                        (peer, id, is_channel, *record.values(), time.time()))
+        self.schedule_commit()
+
+    def get(self, peer, id):
+        key = (peer, id)
+        if key in self.hot:
+            self.hot.move_to_end(key)
+            return self.hot[key]
+        row = self.db.execute('SELECT mid, text, rendered_text, user, channel, media '
+                              'FROM messages WHERE peer = ? AND id = ?', key).fetchone()
+        if row is None:
+            return None
+        record = cached_message(*row)
+        self.to_hot(key, record)
+        return record
+
+    def to_hot(self, key, record):
+        old = self.hot.pop(key, None)
+        if old:
+            self.hot_used -= old.size
+        self.hot[key] = record
+        self.hot_used += record.size
+        while self.hot_used > self.hot_bytes and len(self.hot) > 1:
+            _, old = self.hot.popitem(last=False)
+            self.hot_used -= old.size
+
+    def get_not_channel(self, id):
+        # Ids of messages not in channels (privates and basic groups) are
+        # unique for the account, Telegram doesn't tell the peer in some
+        # updates (e.g. deletions)
+        peer = self.get_not_channel_peer(id)
+        return self.get(peer, id) if peer is not None else None
+
+    def get_not_channel_peer(self, id):
+        row = self.db.execute('SELECT peer FROM messages WHERE id = ? AND is_channel = 0', (id,)).fetchone()
+        return row[0] if row else None
+
+    def put_event(self, peer, prev_id, elem):
+        self.db.execute('INSERT INTO events VALUES (?,?,?,?,?,?,?)',
+                        (peer, prev_id, elem['id'], elem['rendered_event'], elem['user'],
+                         elem['channel'], elem['date'].timestamp()))
+        self.schedule_commit()
+
+    def get_events(self, peer, prev_id):
+        rows = self.db.execute('SELECT id, rendered_event, user, channel, date FROM events '
+                               'WHERE peer = ? AND prev_id = ? ORDER BY rowid', (peer, prev_id))
+        return [ { 'id': id,
+                   'rendered_event': ev,
+                   'user': user,
+                   'channel': chan,
+                   'date': datetime.datetime.fromtimestamp(date, datetime.timezone.utc),
+                 } for id, ev, user, chan, date in rows ]
+
+    def get_mesg_bases(self):
+        return dict(self.db.execute('SELECT peer, base FROM mesg_base'))
+
+    def put_mesg_base(self, peer, base):
+        self.db.execute('INSERT OR REPLACE INTO mesg_base VALUES (?,?)', (peer, base))
+        self.schedule_commit()
+
+    def put_media(self, name, peer, id, store, size):
+        self.db.execute('INSERT OR REPLACE INTO media VALUES (?,?,?,?,?,?)',
+                        (name, peer, id, store, size, time.time()))
+        self.schedule_commit()
+
+    def get_media(self, name):
+        return self.db.execute('SELECT peer, id, store, size FROM media WHERE name = ?', (name,)).fetchone()
+
+    def schedule_commit(self):
+        # Writes are committed together a bit later
+        if self.commit_handle is None:
+            self.commit_handle = asyncio.get_event_loop().call_later(COMMIT_DELAY, self.commit)
+
+    def commit(self):
+        self.commit_handle = None
+        self.db.commit()
+        if time.time() - self.last_prune > PRUNE_INTERVAL and not self.prune_task:
+            self.prune_task = asyncio.create_task(self.prune())
+
+    def close(self):
+        # Pending writes are committed
+        if self.commit_handle:
+            self.commit_handle.cancel()
+            self.commit_handle = None
+        if self.prune_task:
+            self.prune_task.cancel()
+        self.db.commit()
+        self.db.close()
+
+    async def prune(self):
+        # Retention, for messages, events and media descriptors separately:
+        # older than max_days (if set) and the oldest written over
+        # max_messages (if set)
+        self.last_prune = time.time()
+        deleted = 0
+        try:
+            for table in ('messages', 'events', 'media'):
+                count = 0
+                if self.max_days:
+                    limit = self.last_prune - self.max_days * 86400
+                    count += await self.delete_batches(table, 'date < ?', limit)
+                if self.max_messages:
+                    row = self.db.execute('SELECT rowid FROM {} ORDER BY rowid DESC LIMIT 1 OFFSET ?'.format(table),
+                                          (self.max_messages,)).fetchone()
+                    if row:
+                        count += await self.delete_batches(table, 'rowid <= ?', row[0])
+                if table == 'messages':
+                    deleted = count
+        finally:
+            self.prune_task = None
+        if deleted:
+            self.logger.info('Message store: %s old messages removed', deleted)
+
+    async def delete_batches(self, table, condition, param):
+        count = 0
+        while True:
+            rows = self.db.execute('DELETE FROM {0} WHERE rowid IN (SELECT rowid FROM {0} WHERE {1} LIMIT ?)'
+                                   .format(table, condition), (param, PRUNE_BATCH)).rowcount
+            self.db.commit()
+            count += rows
+            if rows < PRUNE_BATCH:
+                return count
+            await asyncio.sleep(0)
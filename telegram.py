@@ -10,11 +10,15 @@
 
 import logging
 import os
-import re
+import json
 import asyncio
 import collections
+import errno
+import functools
 import telethon
 import random
+import time
+import urllib.parse
 from getpass import getpass
 from telethon import types as tgty, utils as tgutils
 from telethon.tl.functions.messages import GetMessagesReactionsRequest, GetFullChatRequest
@@ -27,6 +31,8 @@ from include import CHAN_MAX_LENGTH, NICK_MAX_LENGTH
 from irc import IRCUser
 from utils import sanitize_filename, add_filename, is_url_equiv, extract_url, get_human_size, get_human_duration
 from utils import get_highlighted, fix_braces, pretty, current_date, hash_token
+from store import message_store, cached_message, media_digest
+from media import download_queue, media_cache, media_server, part_file, PART_SIZE, PARTS_MIN_SIZE
 import emoji2emoticon as e
 
 # Test IP table
@@ -45,9 +51,21 @@ class TelegramHandler(object):
         self.cache_dir  = settings['cache_dir']
         self.download   = settings['download_media']
         self.notice_size = settings['download_notice'] * 1048576
+        self.download_lazy = settings['download_lazy'] and settings['media_server']
+        if settings['download_lazy'] and not settings['media_server']:
+            self.logger.warning('download_lazy requires media_server, media will be downloaded at once')
+        self.downloads  = download_queue(settings['download_parallel'], settings['download_parallel_chat'])
+        self.download_parts = settings['download_parts']
         self.media_dir  = settings['media_dir']
         self.media_url  = settings['media_url']
-        if self.media_url[-1:] != '/':
+        self.media_quota = settings['media_quota'] * 1048576
+        self.media_days = settings['media_max_days']
+        self.media_server = settings['media_server']
+        self.media_server_address = settings['media_server_address']
+        self.media_server_port = settings['media_server_port']
+        if not self.media_url and self.media_server:
+            self.media_url = 'http://{}:{}/'.format(self.media_server_address, self.media_server_port)
+        if self.media_url and self.media_url[-1:] != '/':
             self.media_url += '/'
         self.upload_dir = settings['upload_dir']
         self.api_id     = settings['api_id']
@@ -64,6 +82,13 @@ class TelegramHandler(object):
         self.log_del    = settings['log_deleted']
         self.high       = settings['chars_highlight']
         self.mention    = settings['chars_mention']
+        self.info_ttl   = settings['chat_info_ttl']
+        self.parallel   = settings['parallel_requests']
+        self.topics_semaphore = asyncio.Semaphore(self.parallel)
+        self.mapping_save = settings['mapping_save_interval']
+        self.msg_cache_mem = settings['message_cache_memory'] * 1048576
+        self.msg_store_size = settings['message_store_size']
+        self.msg_store_days = settings['message_store_days']
         if not settings['emoji_ascii']:
             e.emo = {}
         self.random_token = random.randbytes(5)
@@ -71,14 +96,25 @@ class TelegramHandler(object):
         self.authorized = False
         self.id	= None
         self.tg_username = None
-        self.channels_date = {}
+        self.topics = {}
+        self.topics_tasks = {}
+        self.entities = collections.OrderedDict()
+        self.entities_max = settings['entity_cache_size']
+        self.entities_hits = 0
+        self.entities_misses = 0
+        self.presence = collections.OrderedDict()
+        self.flood_until = 0
+        self.participants_task = None
+        self.media_cache_task = None
+        self.mapping_task = None
         self.mid = mesg_id('0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ!#$%+./_~')
         self.webpending = {}
+        self.link_tasks = set()
         self.refwd_me = False
-        self.cache = collections.OrderedDict()
-        self.volatile_cache = collections.OrderedDict()
+        self.store = None
         self.prev_id = {}
         self.lookup_usernames = set()
+        self.saved_users = {}
         self.last_reaction = None
         self.tid_to_token = {}
         self.rargs = {}
@@ -90,12 +126,31 @@ class TelegramHandler(object):
         self.telegram_media_dir = os.path.expanduser(self.media_dir or os.path.join(self.cache_dir, 'media'))
         if not os.path.exists(self.telegram_media_dir):
             os.makedirs(self.telegram_media_dir)
+        # Content store, files by Telegram id, linked to the names of messages
+        self.telegram_media_store = os.path.join(self.telegram_media_dir, '.store')
+        if not os.path.exists(self.telegram_media_store):
+            os.makedirs(self.telegram_media_store)
+        self.media_cache = media_cache(self.telegram_media_dir, self.telegram_media_store,
+                                       self.media_quota, self.media_days)
+        if self.media_cache.enabled:
+            self.media_cache_task = asyncio.create_task(self.media_cache.run())
+        if not self.media_url:
+            # Without a webserver, at least usable from the same host
+            self.media_url = 'file://' + urllib.parse.quote(os.path.abspath(self.telegram_media_dir)) + '/'
 
         # Setup upload folder
         self.telegram_upload_dir = os.path.expanduser(self.upload_dir or os.path.join(self.cache_dir, 'upload'))
         if not os.path.exists(self.telegram_upload_dir):
             os.makedirs(self.telegram_upload_dir)
 
+        # Setup message store
+        store_dir = os.path.expanduser(self.cache_dir)
+        if not os.path.exists(store_dir):
+            os.makedirs(store_dir)
+        self.store = message_store(os.path.join(store_dir, 'messages.db'), self.msg_cache_mem,
+                                   self.msg_store_size, self.msg_store_days)
+        self.mid.set_store(self.store)
+
         # Setup session folder
         self.telegram_session_dir = os.path.join(self.config_dir, 'session')
         if not os.path.exists(self.telegram_session_dir):
@@ -111,6 +166,7 @@ class TelegramHandler(object):
 
         # Initialize Telegram ID to IRC nick mapping
         self.tid_to_iid = {}
+        self.mapping_file = os.path.join(os.path.expanduser(self.cache_dir), 'mapping.json')
 
         # Register Telegram callbacks
         callbacks = (
@@ -123,6 +179,14 @@ class TelegramHandler(object):
         for handler, event in callbacks:
             self.telegram_client.add_event_handler(handler, event)
 
+        # Start media webserver, it uses the message store and the client
+        # to get the files not present
+        if self.media_server:
+            self.media_server = media_server(self.telegram_media_dir, self.media_cache,
+                                             self.media_server_address, self.media_server_port,
+                                             self.fetch_media)
+            await self.media_server.start()
+
         # Start Telegram client
         if self.test:
             await self.telegram_client.start(self.phone, code_callback=lambda: str(self.test_dc) * 5)
@@ -173,18 +237,148 @@ class TelegramHandler(object):
         self.auth_checked.set()
         await self.init_mapping()
 
+    def shutdown(self):
+        # Called when the loop has stopped
+        if self.store:
+            self.store.close()
+
     async def init_mapping(self):
         # Update IRC <-> Telegram mapping
         tg_user = await self.telegram_client.get_me()
         self.id = tg_user.id
-        self.tg_username = self.get_telegram_nick(tg_user)
-        self.set_ircuser_from_telegram(tg_user)
+        # Start with the mapping saved in the last run (if any), so the users
+        # and channels are available (and with the same nicks) while they are
+        # got again from Telegram
+        saved_chans = self.load_mapping() if self.mapping_save else set()
+        self.tg_username = self.set_ircuser_from_telegram(tg_user)
+        chats = []
         async for dialog in self.telegram_client.iter_dialogs():
             chat = dialog.entity
+            self.cache_entity(chat)
             if isinstance(chat, tgty.User):
                 self.set_ircuser_from_telegram(chat)
             else:
-                await self.set_irc_channel_from_telegram(chat)
+                channel = self.set_irc_channel_from_telegram(chat)
+                saved_chans.discard(channel.lower())
+                chats.append(chat)
+        # Saved channels that are not in the dialogs anymore
+        for chan in saved_chans:
+            self.del_irc_channel_telegram_members(chan)
+            self.del_irc_channel_telegram_status(chan)
+            if not self.irc.irc_channels[chan]:
+                del self.irc.irc_channels[chan]
+        # Channels can be used already, their participants are added
+        # progressively in background
+        self.participants_task = asyncio.create_task(self.load_participants(chats))
+
+    async def load_participants(self, chats):
+        semaphore = asyncio.Semaphore(self.parallel)
+        async def load(chat):
+            async with semaphore:
+                return await self.set_irc_channel_participants(chat)
+
+        loaded = await asyncio.gather(*(load(chat) for chat in chats))
+        self.logger.info('Participants of %s channels loaded', len(chats))
+        await self.update_saved_users(drop=all(loaded))
+        if self.mapping_save:
+            self.mapping_task = asyncio.create_task(self.save_mapping_periodically())
+
+    def load_mapping(self):
+        try:
+            with open(self.mapping_file) as f:
+                mapping = json.load(f)
+        except FileNotFoundError:
+            return set()
+        except (OSError, ValueError) as err:
+            self.logger.warning('Not possible to load mapping from %s: %s', self.mapping_file, repr(err))
+            return set()
+        # Checked before modifying anything, a file with other structure is
+        # ignored as a missing one (everything is got from Telegram)
+        try:
+            if mapping['id'] != self.id:
+                self.logger.info('Mapping in %s is from another Telegram account, ignored', self.mapping_file)
+                return set()
+            ids = { int(tid): str(iid) for tid, iid in mapping['ids'] }
+            users = [ (int(tid), ids[int(tid)], str(realname)) for tid, realname in mapping['users'] ]
+            channels = [ (ids[int(tid)].lower(), [ str(x) for x in members ], [ str(x) for x in ops ],
+                          [ str(x) for x in founders ]) for tid, members, ops, founders in mapping['channels'] ]
+        except (KeyError, TypeError, ValueError) as err:
+            self.logger.warning('Not valid mapping in %s: %s', self.mapping_file, repr(err))
+            return set()
+
+        for tid, iid in ids.items():
+            self.tid_to_iid[tid] = iid
+            self.irc.iid_to_tid[iid.lower()] = tid
+        for tid, nick, realname in users:
+            ni = nick.lower()
+            self.irc.users[ni] = IRCUser(None, ('Telegram',''), nick, tid, realname)
+            self.lookup_usernames.add(ni)
+            self.lookup_usernames.add(nick)
+            # To be checked with the user got from Telegram
+            self.saved_users[tid] = None
+        chans = set()
+        for chan, members, ops, founders in channels:
+            chans.add(chan)
+            if chan not in self.irc.irc_channels:
+                self.irc.irc_channels[chan] = set()
+            for nick in members:
+                self.irc.add_channel_member(chan, nick)
+            for nick in ops:
+                self.irc.add_channel_op(chan, nick)
+            for nick in founders:
+                self.irc.add_channel_founder(chan, nick)
+        self.logger.info('Mapping loaded from %s: %s users, %s channels', self.mapping_file,
+                         len(users), len(chans))
+        return chans
+
+    def save_mapping(self):
+        # Only Telegram users are saved, not IRC clients nor the service user
+        users = { ni: user for ni, user in self.irc.users.items() if self.is_telegram_user(user) }
+        channels = []
+        for chan, members in self.irc.irc_channels.items():
+            if chan in self.irc.iid_to_tid:
+                channels.append((self.irc.iid_to_tid[chan],
+                                 [ nick for nick in members if nick.lower() in users ],
+                                 list(self.irc.irc_channels_ops[chan]),
+                                 list(self.irc.irc_channels_founder[chan])))
+        mapping = { 'id': self.id,
+                    'ids': list(self.tid_to_iid.items()),
+                    'users': [ (int(user.irc_username), user.irc_realname) for user in users.values() ],
+                    'channels': channels,
+                  }
+        # Written to a temporary file and renamed, to not leave a partial one
+        tmp_file = self.mapping_file + '.tmp'
+        try:
+            os.makedirs(os.path.dirname(self.mapping_file), exist_ok=True)
+            with open(tmp_file, 'w') as f:
+                json.dump(mapping, f, separators=(',', ':'))
+            os.replace(tmp_file, self.mapping_file)
+        except OSError as err:
+            self.logger.warning('Not possible to save mapping to %s: %s', self.mapping_file, repr(err))
+
+    async def save_mapping_periodically(self):
+        while True:
+            self.save_mapping()
+            await asyncio.sleep(self.mapping_save)
+
+    def is_telegram_user(self, user):
+        return not user.stream and not user.is_service
+
+    def del_irc_channel_telegram_members(self, chan, keep=()):
+        for nick in list(self.irc.irc_channels[chan]):
+            if nick not in keep and self.is_telegram_user(self.irc.users[nick.lower()]):
+                self.irc.del_channel_member(chan, nick)
+
+    def del_irc_channel_telegram_status(self, chan, ops=(), founders=()):
+        # Only of Telegram users, not of IRC users in the channel
+        def is_telegram_nick(nick):
+            user = self.irc.users.get(nick.lower())
+            return user is None or self.is_telegram_user(user)
+
+        for nick in [ x for x in self.irc.irc_channels_ops[chan] if x not in ops and is_telegram_nick(x) ]:
+            self.irc.del_channel_op(chan, nick)
+        for nick in [ x for x in self.irc.irc_channels_founder[chan] if x not in founders and is_telegram_nick(x) ]:
+            self.irc.del_channel_founder(chan, nick)
 
     def set_ircuser_from_telegram(self, user):
         if user.id not in self.tid_to_iid:
@@ -199,30 +393,118 @@ class TelegramHandler(object):
             self.irc.iid_to_tid[tg_ni] = user.id
         else:
             tg_nick = self.tid_to_iid[user.id]
+            if user.id in self.saved_users:
+                self.saved_users[user.id] = user
         return tg_nick
 
-    async def set_irc_channel_from_telegram(self, chat):
-        channel = self.get_telegram_channel(chat)
+    def set_irc_channel_from_telegram(self, chat):
+        if chat.id in self.tid_to_iid:
+            # Keep the name already mapped
+            channel = self.tid_to_iid[chat.id]
+        else:
+            channel = self.get_telegram_channel(chat)
         self.tid_to_iid[chat.id] = channel
         chan = channel.lower()
         self.irc.iid_to_tid[chan] = chat.id
-        self.irc.irc_channels[chan] = set()
+        if chan not in self.irc.irc_channels:
+            self.irc.irc_channels[chan] = set()
+        return channel
+
+    async def set_irc_channel_participants(self, chat):
+        channel = self.tid_to_iid[chat.id]
+        chan = channel.lower()
         # Add users from the channel
-        try:
+        async def add_participants():
+            members = set()
+            ops = set()
+            founders = set()
             async for user in self.telegram_client.iter_participants(chat.id):
+                self.cache_entity(user)
                 user_nick = self.set_ircuser_from_telegram(user)
                 if not user.is_self:
-                    self.irc.irc_channels[chan].add(user_nick)
+                    self.irc.add_channel_member(chan, user_nick)
+                    members.add(user_nick)
                 # Add admin users as ops in irc
                 if isinstance(user.participant, tgty.ChatParticipantAdmin) or \
                    isinstance(user.participant, tgty.ChannelParticipantAdmin):
-                    self.irc.irc_channels_ops[chan].add(user_nick)
+                    self.irc.add_channel_op(chan, user_nick)
+                    ops.add(user_nick)
                 # Add creator users as founders in irc
                 elif isinstance(user.participant, tgty.ChatParticipantCreator) or \
                      isinstance(user.participant, tgty.ChannelParticipantCreator):
-                    self.irc.irc_channels_founder[chan].add(user_nick)
+                    self.irc.add_channel_founder(chan, user_nick)
+                    founders.add(user_nick)
+            # Remove what was loaded from the saved mapping but is not valid anymore
+            self.del_irc_channel_telegram_members(chan, keep=members)
+            self.del_irc_channel_telegram_status(chan, ops, founders)
+        try:
+            await self.flood_retry(add_participants)
         except:
             self.logger.warning('Not possible to get participants of channel %s', channel)
+            return False
+        return True
+
+    async def update_saved_users(self, drop):
+        # Users loaded from the saved mapping are renamed if their nick has
+        # changed in Telegram and, if drop (all the participants were got),
+        # removed if not found
+        for tid, user in self.saved_users.items():
+            nick = self.tid_to_iid.get(tid)
+            irc_user = self.irc.users.get(nick.lower()) if nick else None
+            if not irc_user or not self.is_telegram_user(irc_user):
+                continue
+            if user:
+                irc_user.irc_realname = self.get_telegram_display_name(user)
+                del self.irc.iid_to_tid[nick.lower()]
+                new_nick = self.get_telegram_nick(user)
+                self.irc.iid_to_tid[nick.lower()] = tid
+                if new_nick != nick:
+                    self.logger.info('Telegram user %s renamed from %s to %s', tid, nick, new_nick)
+                    await self.irc.send_users_irc(irc_user, 'NICK', (new_nick,))
+                    self.rename_irc_user(irc_user, new_nick)
+            elif drop:
+                self.logger.info('Telegram user %s (%s) not found, removed', tid, nick)
+                await self.irc.send_users_irc(irc_user, 'QUIT', (':Not found in Telegram',))
+                self.del_irc_user(irc_user)
+        self.saved_users = {}
+
+    def rename_irc_user(self, irc_user, new_nick):
+        nick = irc_user.irc_nick
+        tid = self.irc.iid_to_tid.pop(nick.lower())
+        del self.irc.users[nick.lower()]
+        self.lookup_usernames.discard(nick)
+        self.lookup_usernames.discard(nick.lower())
+        irc_user.irc_nick = new_nick
+        self.irc.users[new_nick.lower()] = irc_user
+        self.irc.iid_to_tid[new_nick.lower()] = tid
+        self.tid_to_iid[tid] = new_nick
+        self.lookup_usernames.add(new_nick)
+        self.lookup_usernames.add(new_nick.lower())
+        self.irc.rename_channel_member(nick, new_nick)
+
+    def del_irc_user(self, irc_user):
+        nick = irc_user.irc_nick
+        for chan in list(self.irc.irc_nick_channels.get(nick, ())):
+            self.irc.del_channel_member(chan, nick)
+        tid = self.irc.iid_to_tid.pop(nick.lower())
+        del self.irc.users[nick.lower()]
+        del self.tid_to_iid[tid]
+        self.lookup_usernames.discard(nick)
+        self.lookup_usernames.discard(nick.lower())
+
+    async def flood_retry(self, func, *args):
+        # Call to Telegram in func (coroutine function), if Telegram asks to wait
+        # (flood wait) it's called again later, the wait is shared by all the
+        # tasks that use this function
+        while True:
+            delay = self.flood_until - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            try:
+                return await func(*args)
+            except telethon.errors.FloodWaitError as err:
+                self.logger.warning('Telegram requested to wait %s seconds (flood)', err.seconds)
+                self.flood_until = max(self.flood_until, time.monotonic() + err.seconds)
 
     def get_telegram_nick(self, user):
         nick = (user.username
@@ -288,7 +570,7 @@ class TelegramHandler(object):
 
     async def get_irc_nick_from_telegram_id(self, tid, entity=None):
         if tid not in self.tid_to_iid:
-            user = entity or await self.telegram_client.get_entity(tid)
+            user = await self.get_entity(tid, entity)
             nick = self.get_telegram_nick(user)
             self.tid_to_iid[tid]  = nick
             self.irc.iid_to_tid[nick] = tid
@@ -298,7 +580,7 @@ class TelegramHandler(object):
     async def get_irc_channel_from_telegram_id(self, tid, entity=None):
         rtid, type = tgutils.resolve_id(tid)
         if rtid not in self.tid_to_iid:
-            chat    = entity or await self.telegram_client.get_entity(tid)
+            chat    = await self.get_entity(tid, entity)
             channel = self.get_telegram_channel(chat)
             self.tid_to_iid[rtid]     = channel
             self.irc.iid_to_tid[channel] = rtid
@@ -312,7 +594,7 @@ class TelegramHandler(object):
             user_nick = await self.get_irc_nick_from_telegram_id(user.id, user)
 
             nicks.append(user_nick)
-            self.irc.irc_channels[channel].add(user_nick)
+            self.irc.add_channel_member(channel.lower(), user_nick)
 
         return nicks
 
@@ -320,30 +602,38 @@ class TelegramHandler(object):
         if self.irc.users[irc_nick].is_service:
             return None
         tid = self.get_tid(irc_nick, tid)
-        user = await self.telegram_client.get_entity(tid)
-        if isinstance(user.status,tgty.UserStatusRecently) or \
-           isinstance(user.status,tgty.UserStatusOnline):
+        # Status from the presence table, only requested if never received
+        if tid in self.presence:
+            self.presence.move_to_end(tid)
+            status = self.presence[tid]
+        else:
+            user = await self.get_entity(tid)
+            status = user.status
+            self.set_presence(tid, status)
+        if isinstance(status,tgty.UserStatusOnline) and status.expires < current_date():
+            # online expired without an update, it's the last time seen
+            idle = int((current_date() - status.expires).total_seconds())
+        elif isinstance(status,tgty.UserStatusRecently) or \
+           isinstance(status,tgty.UserStatusOnline):
             idle = 0
-        elif isinstance(user.status,tgty.UserStatusOffline):
-            last = user.status.was_online
+        elif isinstance(status,tgty.UserStatusOffline):
+            last = status.was_online
             current = current_date()
             idle = int((current - last).total_seconds())
-        elif isinstance(user.status,tgty.UserStatusLastWeek):
+        elif isinstance(status,tgty.UserStatusLastWeek):
             idle = 604800
-        elif isinstance(user.status,tgty.UserStatusLastMonth):
+        elif isinstance(status,tgty.UserStatusLastMonth):
             idle = 2678400
         else:
             idle = None
         return idle
 
-    async def get_channel_topic(self, channel, entity_cache):
+    async def get_channel_topic(self, channel):
         tid = self.get_tid(channel)
-        # entity_cache should be a list to be a persistent and by reference value
-        if entity_cache[0]:
-            entity = entity_cache[0]
-        else:
-            entity = await self.telegram_client.get_entity(tid)
-            entity_cache[0] = entity
+        # Served from cache if not expired or invalidated by an update
+        if self.is_topic_cached(tid):
+            return self.topics[tid][0]
+        entity = await self.get_entity(tid)
         if isinstance(entity, tgty.Channel): 
             full = await self.telegram_client(GetFullChannelRequest(channel=entity))
         elif isinstance(entity, tgty.Chat):
@@ -353,22 +643,85 @@ class TelegramHandler(object):
         entity_type = self.get_entity_type(entity, format='long')
         topic = full.full_chat.about
         sep = ': ' if topic else ''
-        return entity_type + sep + topic
+        topic = entity_type + sep + topic
+        self.topics[tid] = (topic, time.monotonic())
+        return topic
+
+    def is_topic_cached(self, tid):
+        return tid in self.topics and time.monotonic() - self.topics[tid][1] < self.info_ttl
+
+    def get_cached_topic(self, channel):
+        # Topic from cache even if expired, None if not got yet
+        topic = self.topics.get(self.get_tid(channel))
+        return topic[0] if topic else None
+
+    def refresh_channel_topics(self, channels):
+        # Get in background the topics not cached (or expired) with a limited
+        # number of concurrent requests (for all the calls), the ones in
+        # progress are not repeated. Returns the tasks by channel
+        tasks = {}
+        for chan in channels:
+            tid = self.get_tid(chan)
+            if self.is_topic_cached(tid):
+                continue
+            if tid not in self.topics_tasks:
+                self.topics_tasks[tid] = asyncio.create_task(self.refresh_channel_topic(tid, chan))
+            tasks[chan] = self.topics_tasks[tid]
+        return tasks
+
+    async def refresh_channel_topic(self, tid, channel):
+        try:
+            async with self.topics_semaphore:
+                await self.flood_retry(self.get_channel_topic, channel)
+        except Exception as err:
+            self.logger.warning('Not possible to get topic of channel %s: %s', channel, repr(err))
+        finally:
+            del self.topics_tasks[tid]
 
-    async def get_channel_creation(self, channel, entity_cache):
+    async def get_channel_creation(self, channel):
         tid = self.get_tid(channel)
-        if tid in self.channels_date.keys():
-            timestamp = self.channels_date[tid]
+        entity = await self.get_entity(tid)
+        return int(entity.date.timestamp())
+
+    async def get_entity(self, tid, entity=None):
+        # Entities (users, chats and channels) by id, requested to Telegram only
+        # if not present, the least recently used are discarded when full and
+        # updates from Telegram about changes invalidate them, entity is a
+        # fresh one to be cached (e.g. from an event or iteration)
+        key, _ = tgutils.resolve_id(tid)
+        if entity:
+            self.cache_entity(entity, key)
+        elif key in self.entities:
+            self.entities.move_to_end(key)
+            self.entities_hits += 1
+            entity = self.entities[key]
         else:
-            # entity_cache should be a list to be a persistent and by reference value
-            if entity_cache[0]:
-                entity = entity_cache[0]
-            else:
-                entity = await self.telegram_client.get_entity(tid)
-                entity_cache[0] = entity
-            timestamp = entity.date.timestamp()
-            self.channels_date[tid] = timestamp
-        return int(timestamp)
+            self.entities_misses += 1
+            self.logger.debug('Entity cache miss: %s (hits: %s, misses: %s, size: %s)', key,
+                              self.entities_hits, self.entities_misses, len(self.entities))
+            entity = await self.telegram_client.get_entity(tid)
+            self.cache_entity(entity, key)
+        return entity
+
+    def cache_entity(self, entity, key=None):
+        if key is None:
+            key = entity.id
+        if isinstance(entity, tgty.User):
+            self.set_presence(entity.id, entity.status)
+        self.entities[key] = entity
+        self.entities.move_to_end(key)
+        if len(self.entities) > self.entities_max:
+            self.entities.popitem(last=False)
+
+    def invalidate_entity(self, key):
+        self.entities.pop(key, None)
+
+    def set_presence(self, tid, status):
+        # Same limit as the entities, the least recently used are discarded
+        self.presence[tid] = status
+        self.presence.move_to_end(tid)
+        if len(self.presence) > self.entities_max:
+            self.presence.popitem(last=False)
 
     def get_tid(self, irc_item, tid=None):
         it = irc_item.lower()
@@ -428,19 +781,17 @@ class TelegramHandler(object):
         if user.stream or user.is_service:
             bot = False
         else:
-            bot = user.bot
-        if bot == None:
             tid = self.get_tid(irc_nick, tid)
-            tg_user = await self.telegram_client.get_entity(tid)
+            tg_user = await self.get_entity(tid)
             bot = tg_user.bot
-            user.bot = bot
         return bot
 
     async def edition_case(self, msg):
         def msg_edited(m):
-            return m.id in self.cache and \
-                   ( m.message != self.cache[m.id]['text']
-                     or m.media != self.cache[m.id]['media']
+            cached = self.from_cache(m.peer_id, m.id)
+            return cached is not None and \
+                   ( m.message != cached.text
+                     or media_digest(m.media) != cached.media
                    )
         async def get_reactions(m):
             react = await self.telegram_client(GetMessagesReactionsRequest(m.peer_id, id=[m.id]))
@@ -466,69 +817,71 @@ class TelegramHandler(object):
             react = None
         return case, react
 
-    def to_cache(self, id, mid, message, proc_message, user, chan, media):
-        self.limit_cache(self.cache)
-        self.cache[id] = {
-                           'mid': mid,
-                           'text': message,
-                           'rendered_text': proc_message,
-                           'user': user,
-                           'channel': chan,
-                           'media': media,
-                         }
-
-    def to_volatile_cache(self, prev_id, id, ev, user, chan, date):
-        if chan in prev_id:
-            prid = prev_id[chan] if chan else prev_id[user]
-            self.limit_cache(self.volatile_cache)
-            elem = {
-                     'id': id,
-                     'rendered_event': ev,
-                     'user': user,
-                     'channel': chan,
-                     'date': date,
-                   }
-            if prid not in self.volatile_cache:
-                self.volatile_cache[prid] = [elem]
-            else:
-                self.volatile_cache[prid].append(elem)
-
-    def limit_cache(self, cache):
-        if len(cache) >= 10000:
-            cache.popitem(last=False)
+    def to_cache(self, peer, id, mid, message, proc_message, user, chan, media):
+        self.store.put(self.mid.get_peer_id(peer), id, isinstance(peer, tgty.PeerChannel),
+                       cached_message(mid, message, proc_message, user.irc_nick if user else None,
+                                      chan, media_digest(media)))
+
+    def from_cache(self, peer, id):
+        # peer None: message not in a channel, it's found only by id
+        if peer is None:
+            return self.store.get_not_channel(id)
+        return self.store.get(self.mid.get_peer_id(peer), id)
+
+    def get_cached_user(self, nick):
+        return self.irc.users.get(nick.lower()) if nick else None
+
+    def to_volatile_cache(self, peer, id, ev, user, chan, date):
+        # Events are kept by Telegram peer (channel, chat or private) and the
+        # id of the last message in it, to be shown after that message
+        peer_id = self.mid.get_peer_id(peer) if peer is not None else None
+        if peer_id is None or peer_id not in self.prev_id:
+            return
+        elem = {
+                 'id': id,
+                 'rendered_event': ev,
+                 'user': user.irc_nick if user else None,
+                 'channel': chan,
+                 'date': date,
+               }
+        self.store.put_event(peer_id, self.prev_id[peer_id], elem)
 
     def replace_mentions(self, text, me_nick='', received=True):
         # For received, e.g. with defaults, replace @mention to ~mention~
         # For sent replace mention: to @mention
         def repl_mentioned(text, me_nick, received, local_high_ini, local_high_end, local_ment_ini, local_ment_end, tg_at):
-            new_text = text
-
-            if me_nick:
-                usernames = (self.tg_username,)
-            else:
-                usernames = self.lookup_usernames
-
-            for user in usernames:
-                if user == self.tg_username:
-                    if me_nick:
-                        username = me_nick
-                    else:
+            # Words (separated by spaces) are looked up in the usernames
+            # set, all the mentions are replaced in one pass
+            if received:
+                ini, end = tg_at, ''
+            else: # sent
+                ini, end = local_ment_ini, local_ment_end
+            len_ini = len(ini)
+            len_ini_end = len_ini + len(end)
+            words = text.split(' ')
+            last = len(words) - 1
+            for n, word in enumerate(words):
+                # A mention can be followed by a newline at the end of text
+                nl = '\n' if n == last and word[-1:] == '\n' else ''
+                if nl:
+                    word = word[:-1]
+                if len(word) <= len_ini_end or not word.startswith(ini) or not word.endswith(end):
+                    continue
+                user = word[len_ini:len(word) - len(end)]
+                if me_nick:
+                    if user != self.tg_username:
                         continue
+                    username = me_nick
+                elif user == self.tg_username or user not in self.lookup_usernames:
+                    continue
                 else:
                     username = user
 
-                if user not in new_text:
-                    continue
-
                 if received:
-                    mention = tg_at + user
-                    replcmnt = local_high_ini + username + local_high_end
+                    words[n] = local_high_ini + username + local_high_end + nl
                 else: # sent
-                    mention = local_ment_ini + user + local_ment_end
-                    replcmnt = tg_at + username
-
-                new_text = re.sub(r'(?:(?<=^)|(?<= ))' + re.escape(mention) + r'(?=$| )', replcmnt.replace('\\', r'\\'), new_text)
-            return new_text
+                    words[n] = tg_at + username + nl
+            return ' '.join(words)
 
         def space_to_empty(string, index):
             if len(string) > index:
@@ -562,7 +915,9 @@ class TelegramHandler(object):
 
     def filters(self, text):
         filtered = e.replace_mult(text, e.emo)
-        filtered = self.replace_mentions(filtered)
+        # Received mentions start with '@', most texts don't have any
+        if '@' in filtered:
+            filtered = self.replace_mentions(filtered)
         return filtered
 
     def format_reaction(self, msg, message_rendered, edition_case, reaction):
@@ -597,9 +952,9 @@ class TelegramHandler(object):
         if edition_case == 'edition':
             action = 'Edited'
             user = self.get_irc_user_from_telegram(event.sender_id)
-            if id in self.cache:
-                t = self.filters(self.cache[id]['text'])
-                rt = self.cache[id]['rendered_text']
+            if cached := self.from_cache(event.message.peer_id, id):
+                t = self.filters(cached.text)
+                rt = cached.rendered_text
 
                 ht, is_ht = get_highlighted(t, message)
             else:
@@ -630,8 +985,8 @@ class TelegramHandler(object):
 
         chan = await self.relay_telegram_message(event, user, text)
 
-        self.to_cache(id, mid, message, message_rendered, user, chan, event.message.media)
-        self.to_volatile_cache(self.prev_id, id, text, user, chan, current_date())
+        self.to_cache(event.message.peer_id, id, mid, message, message_rendered, user, chan, event.message.media)
+        self.to_volatile_cache(event.message.peer_id, id, text, user, chan, current_date())
 
     async def handle_next_reaction(self, event):
         if not self.show_react:
@@ -655,20 +1010,23 @@ class TelegramHandler(object):
 
             chan = await self.relay_telegram_message(msg, user, text)
 
-            self.to_cache(id, mid, message, message_rendered, user, chan, msg.media)
-            self.to_volatile_cache(self.prev_id, id, text, user, chan, current_date())
+            self.to_cache(msg.peer_id, id, mid, message, message_rendered, user, chan, msg.media)
+            self.to_volatile_cache(msg.peer_id, id, text, user, chan, current_date())
 
     async def handle_telegram_deleted(self, event):
         self.logger.debug('Handling Telegram Message Deleted: %s', pretty(event))
 
+        # Only deletions in channels have the peer, in other case ids are unique
+        channel_id = getattr(event.original_update, 'channel_id', None)
         for deleted_id in event.original_update.messages:
-            if deleted_id in self.cache:
-                recovered_text = self.cache[deleted_id]['rendered_text']
+            peer = channel_id or self.store.get_not_channel_peer(deleted_id)
+            if peer and (cached := self.from_cache(peer, deleted_id)):
+                recovered_text = cached.rendered_text
                 text = '|Deleted| {}'.format(recovered_text)
-                user = self.cache[deleted_id]['user']
-                chan = self.cache[deleted_id]['channel']
+                user = self.get_cached_user(cached.user)
+                chan = cached.channel
                 await self.relay_telegram_message(message=None, user=user, text=text, channel=chan)
-                self.to_volatile_cache(self.prev_id, deleted_id, text, user, chan, current_date())
+                self.to_volatile_cache(peer, deleted_id, text, user, chan, current_date())
             else:
                 if self.log_del:
                     self.logger.info('Message id {} deleted not in cache'.format(deleted_id))
@@ -687,6 +1045,20 @@ class TelegramHandler(object):
         elif isinstance(update, tgty.UpdateMessageReactions):
             await self.handle_next_reaction(update)
 
+        # Info of channel or chat changed (about, title...), get it again when needed
+        elif isinstance(update, tgty.UpdateChannel):
+            self.topics.pop(update.channel_id, None)
+            self.invalidate_entity(update.channel_id)
+        elif isinstance(update, tgty.UpdateChat):
+            self.topics.pop(update.chat_id, None)
+            self.invalidate_entity(update.chat_id)
+
+        # Info of user changed
+        elif isinstance(update, (tgty.UpdateUser, tgty.UpdateUserName, tgty.UpdateUserPhone)):
+            self.invalidate_entity(update.user_id)
+        elif isinstance(update, tgty.UpdateUserStatus):
+            self.set_presence(update.user_id, update.status)
+
     async def handle_telegram_message(self, event, message=None, upd_to_webpend=None, history=False):
         self.logger.debug('Handling Telegram Message: %s', pretty(event or message))
 
@@ -697,11 +1069,11 @@ class TelegramHandler(object):
         text = await self.render_text(msg, mid, upd_to_webpend, user)
         chan = await self.relay_telegram_message(msg, user, text,
             timestamp = msg.date if history else None)
-        await self.history_search_volatile(history, msg.id)
+        peer_id = self.mid.get_peer_id(msg.peer_id)
+        await self.history_search_volatile(history, peer_id, msg.id)
 
-        self.to_cache(msg.id, mid, msg.message, text, user, chan, msg.media)
-        peer = chan if chan else user
-        self.prev_id[peer] = msg.id
+        self.to_cache(msg.peer_id, msg.id, mid, msg.message, text, user, chan, msg.media)
+        self.prev_id[peer_id] = msg.id
 
         self.refwd_me = False
 
@@ -729,15 +1101,14 @@ class TelegramHandler(object):
         final_text = self.filters(final_text)
         return final_text
 
-    async def history_search_volatile(self, history, id):
-        if history:
-            if id in self.volatile_cache:
-                for item in self.volatile_cache[id]:
-                    user = item['user']
-                    text = item['rendered_event']
-                    chan = item['channel']
-                    date = item['date']
-                    await self.relay_telegram_message(None, user, text, chan, timestamp = date)
+    async def history_search_volatile(self, history, peer_id, id):
+        if history and peer_id is not None:
+            for item in self.store.get_events(peer_id, id):
+                user = self.get_cached_user(item['user'])
+                text = item['rendered_event']
+                chan = item['channel']
+                date = item['date']
+                await self.relay_telegram_message(None, user, text, chan, timestamp = date)
 
     async def relay_telegram_message(self, message, user, text, channel=None, timestamp = None):
         private = (message and message.is_private) or (not message and not channel)
@@ -830,9 +1201,9 @@ class TelegramHandler(object):
         else:
             replied_id = message.reply_to.reply_to_msg_id
             cid = self.mid.num_to_id_offset(message.peer_id, replied_id)
-            if replied_id in self.cache:
-                text = self.cache[replied_id]['text']
-                replied_user = self.cache[replied_id]['user']
+            if cached := self.from_cache(message.peer_id, replied_id):
+                text = cached.text
+                replied_user = self.get_cached_user(cached.user)
                 sp = ' '
             else:
                 text = ''
@@ -1067,7 +1438,9 @@ class TelegramHandler(object):
         return size, media_type
 
     async def download_telegram_media(self, message, mid, filename=None, size=0, relay_attr=None):
-        if not self.download:
+        # The URL is returned at once, the download is done in background or
+        # in lazy mode when the URL is requested to the media server
+        if not self.download or message.file is None:
             return ''
         if filename:
             aux_file = filename
@@ -1081,51 +1454,196 @@ class TelegramHandler(object):
         new_file = sanitize_filename(idd_file)
         new_path = os.path.join(self.telegram_media_dir, new_file)
         if os.path.exists(new_path) and (size == 0 or size == os.path.getsize(new_path)):
-            local_path = new_path
+            self.media_cache.touch(new_path)
         else:
-            await self.notice_downloading(size, relay_attr)
-            local_path = await message.download_media(new_path)
-            if not local_path: return ''
-
-        if local_path != new_path:
-            os.replace(local_path, new_path)
+            # The same media (forwarded, sent again or in other chats) is
+            # downloaded only once
+            media = message.file.media
+            store_key = '{}-{}'.format(media.id, media.access_hash)
+            store_path = os.path.join(self.telegram_media_store, store_key)
+            chat = tgutils.get_peer_id(message.peer_id)
+            # To download it again if removed from the media cache
+            self.store.put_media(new_file, chat, message.id, store_key, size or message.file.size or 0)
+            if os.path.exists(store_path):
+                self.link_media(store_path, new_path)
+                self.media_cache.touch(store_path)
+            elif not self.download_lazy:
+                download = self.downloads.add(store_path, chat, size or message.file.size or 0,
+                                              self.download_media_file, message, store_path)
+                task = asyncio.create_task(self.link_downloaded(download, new_path, size, relay_attr))
+                self.link_tasks.add(task)
+                task.add_done_callback(self.link_tasks.discard)
         return self.media_url + new_file
 
-    async def notice_downloading(self, size, relay_attr):
+    async def fetch_media(self, name):
+        # Called by the media server for a file not present, downloaded
+        # before any other (size 0 in the queue) as someone is waiting for
+        # it, the requests of the same file join the same download
+        media = self.store.get_media(name)
+        if media is None:
+            return False
+        peer, id, store_key, size = media
+        store_path = os.path.join(self.telegram_media_store, store_key)
+        if not os.path.exists(store_path):
+            download = self.downloads.add(store_path, peer, 0, self.download_message_media, peer, id, store_path)
+            # Not raised if the download is cancelled, only this request fails
+            await asyncio.wait((download,))
+            if download.cancelled() or not download.result():
+                raise RuntimeError('Download of {} not completed'.format(name))
+        self.link_media(store_path, os.path.join(self.telegram_media_dir, name))
+        return True
+
+    async def download_message_media(self, peer, id, store_path):
+        message = await self.telegram_client.get_messages(peer, ids=id)
+        if message is None or message.file is None:
+            return None
+        return await self.download_media_file(message, store_path)
+
+    async def download_media_file(self, message, store_path):
+        # Downloaded with a temporary name, so a file in the store is complete.
+        # A download in parts interrupted (by the connection or cancelled) is
+        # kept to be resumed, in other case what was downloaded is removed
+        part_path = store_path + '.part'
+        document = message.document
+        in_parts = document and document.size >= PARTS_MIN_SIZE and self.download_parts > 1
+        self.media_cache.add_partial(part_path, message.file.size or 0)
+        try:
+            if in_parts:
+                local_path = await self.download_document_parts(document, part_path)
+            else:
+                local_path = await message.download_media(part_path)
+        except (ConnectionError, TimeoutError, asyncio.TimeoutError, asyncio.CancelledError):
+            if not in_parts:
+                self.media_cache.del_partial(part_path, remove=True)
+            raise
+        except:
+            self.media_cache.del_partial(part_path, remove=True)
+            raise
+        if not local_path:
+            self.media_cache.del_partial(part_path, remove=True)
+            return None
+        os.replace(local_path, store_path)
+        self.media_cache.del_partial(part_path)
+        self.media_cache.add(store_path, os.path.getsize(store_path))
+        return store_path
+
+    async def download_document_parts(self, document, path):
+        # Several parts at the same time (requests pipelined in the sender
+        # of the DC of the file), written at their offsets. The parts already
+        # downloaded by a previous attempt are kept
+        file = part_file(path, document.size)
+        missing = iter(file.missing)
+
+        async def download_parts():
+            for index in missing:
+                async for data in self.telegram_client.iter_download(document, offset=index * PART_SIZE, limit=1,
+                                                                     request_size=PART_SIZE, file_size=document.size):
+                    file.write(index, data)
+
+        # All finish before closing the file, the first error is raised
+        try:
+            results = await asyncio.gather(*(download_parts() for _ in range(self.download_parts)),
+                                           return_exceptions=True)
+        except:
+            file.close()
+            raise
+        # Cancellations of the parts are also returned (BaseException)
+        for result in results:
+            if isinstance(result, BaseException):
+                file.close()
+                raise result
+        file.finish()
+        return path
+
+    async def link_downloaded(self, download, new_path, size, relay_attr):
+        store_path = await download
+        if store_path:
+            try:
+                self.link_media(store_path, new_path)
+            except OSError as err:
+                self.logger.warning('Not possible to link %s to %s: %s', store_path, new_path, repr(err))
+                return
+            await self.notice_downloaded(size, relay_attr)
+
+    def link_media(self, store_path, new_path):
+        # Hard link (same file, no extra space) or symbolic if not possible
+        # (other filesystem or not supported), other errors are raised
+        if os.path.lexists(new_path):
+            os.remove(new_path)
+        try:
+            os.link(store_path, new_path)
+        except OSError as err:
+            if err.errno not in (errno.EXDEV, errno.EPERM, errno.ENOTSUP):
+                raise
+            os.symlink(store_path, new_path)
+        self.media_cache.add_link(store_path, new_path)
+
+    async def notice_downloaded(self, size, relay_attr):
         if relay_attr and size > self.notice_size:
             message, user, mid, media_type = relay_attr
-            await self.relay_telegram_message(message, user, '[{}] [{}] [Downloading]'.format(mid, media_type))
+            await self.relay_telegram_message(message, user, '[{}] [{}] [Downloaded]'.format(mid, media_type))
 
 class mesg_id:
     def __init__(self, alpha):
         self.alpha = alpha
         self.base = len(alpha)
         self.alphaval = { i:v for v, i in enumerate(alpha) }
+        self.alphaset = frozenset(alpha)
+        # Table of ids with two digits (the minimum) and their values
+        self.pairs = [ a + b for a in alpha for b in alpha ]
+        self.pairval = { i:v for v, i in enumerate(self.pairs) }
+        self.square = len(self.pairs)
         self.mesg_base = {}
-
-    def num_to_id(self, num, neg=''):
-        if num < 0: return self.num_to_id(-num, '-')
-        (high, low) = divmod(num, self.base)
-        if high >= self.base:
-            aux = self.num_to_id(high)
-            return neg + aux + self.alpha[low]
-        else:
-            return neg + self.alpha[high] + self.alpha[low]
+        self.store = None
+        # Caches per instance, the conversions depend on the alphabet
+        self.num_to_id_long = functools.lru_cache(maxsize=4096)(self.num_to_id_calc)
+        self.id_to_num_long = functools.lru_cache(maxsize=4096)(self.id_to_num_calc)
+
+    def set_store(self, store):
+        # Offsets are kept in the message store, so the ids are the same
+        # after a restart
+        self.store = store
+        self.mesg_base = store.get_mesg_bases()
+
+    # Conversions are done at least once for every message relayed, most
+    # ids have two digits and are got from the tables, the most recent of
+    # the rest are kept
+
+    def num_to_id(self, num):
+        if 0 <= num < self.square:
+            return self.pairs[num]
+        return self.num_to_id_long(num)
+
+    def num_to_id_calc(self, num):
+        if num < 0:
+            return '-' + self.num_to_id(-num)
+        # Two digits at a time, the first without padding
+        id = ''
+        while num >= self.square:
+            num, low = divmod(num, self.square)
+            id = self.pairs[low] + id
+        return (self.pairs[num] if num >= self.base else self.alpha[num]) + id
 
     def num_to_id_offset(self, peer, num):
         peer_id = self.get_peer_id(peer)
         if peer_id not in self.mesg_base:
             self.mesg_base[peer_id] = num
+            if self.store:
+                self.store.put_mesg_base(peer_id, num)
         return self.num_to_id(num - self.mesg_base[peer_id])
 
-    def id_to_num(self, id, n=1):
-        if id:
-            if id[0] == '-': return self.id_to_num(id[1:], -1)
-            aux = self.alphaval[id[-1:]] * n
-            sum = self.id_to_num(id[:-1], n * self.base)
-            return sum + aux
-        else:
-            return 0
+    def id_to_num(self, id):
+        if id in self.pairval:
+            return self.pairval[id]
+        return self.id_to_num_long(id)
+
+    def id_to_num_calc(self, id):
+        if id[:1] == '-':
+            return -self.id_to_num(id[1:])
+        num = 0
+        for c in id:
+            num = num * self.base + self.alphaval[c]
+        return num
 
     def id_to_num_offset(self, peer, mid):
         peer_id = self.get_peer_id(peer)
@@ -1151,8 +1669,5 @@ class mesg_id:
         return id
 
     def is_in(self, id, alpha):
-        if id == '':
-            return True
-        if id[0] not in alpha:
-            return False
-        return self.is_in(id[1:], alpha)
+        table = self.alphaset if alpha is self.alpha else frozenset(alpha)
+        return table.issuperset(id)
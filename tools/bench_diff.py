@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+#
+# irgramd: IRC-Telegram gateway
+# bench_diff.py: Benchmark of the highlighting of edited messages
+#
+# Copyright (c) 2026 E. Bosch <presidev@AT@gmail.com>
+#
+# Use of this source code is governed by a MIT style license that
+# can be found in the LICENSE file included in this project.
+
+# Compares utils.get_highlighted() (word level Myers diff with a limit)
+# with the previous implementation (difflib.ndiff), run from the top
+# directory of irgramd:
+#   python3 tools/bench_diff.py [number of words of the long post]
+
+import difflib
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from utils import get_highlighted
+
+# Previous implementation, as reference
+
+def old_get_highlighted(a, b):
+    awl = len(a.split())
+    bwl = len(b.split())
+    delta_size = abs(awl - bwl)
+    highlighted = True
+
+    if not a:
+        res = '> {}'.format(b)
+    elif delta_size > 5:
+        res = b
+        highlighted = False
+    else:
+        al = a.split(' ')
+        bl = b.split(' ')
+        ld = list(difflib.ndiff(al, bl))
+        res = ''
+        eq = 0
+
+        for i in ld:
+            if i == '- ' or i[0] == '?':
+                continue
+            elif i == '  ' or i == '+ ':
+                res += ' '
+                continue
+            elif i[0] == '-':
+                res += '-{}- '.format(i[2:])
+            elif i[0] == '+':
+                res += '+{}+ '.format(i[2:])
+            else:
+                res += '{} '.format(i[2:])
+                eq += 1
+
+        delta_eq = bwl - eq
+        if delta_eq > 3:
+            res = b
+            highlighted = False
+
+    return res, highlighted
+
+def words(rand, count):
+    vocabulary = [ ''.join(rand.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(rand.randint(1, 10)))
+                   for _ in range(2000) ]
+    return [ rand.choice(vocabulary) for _ in range(count) ]
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 800
+    rand = random.Random(0)
+    post = words(rand, count)
+    typo = post[:]
+    typo[count // 2] += 'x'
+    added = post[:count // 3] + ['new', 'words', 'here'] + post[count // 3:]
+    text = ' '.join(post)
+    cases = (
+              ('typo fixed', text, ' '.join(typo)),
+              ('same text (link preview)', text, text),
+              ('3 words added', text, ' '.join(added)),
+              ('rewritten (gives up)', text, ' '.join(words(rand, count))),
+              ('short message, one word', 'see you at 5 tomorrow', 'see you at 6 tomorrow'),
+            )
+    print('Per call of get_highlighted, long post of {} words'.format(count))
+    for name, a, b in cases:
+        old = old_get_highlighted(a, b)
+        new = get_highlighted(a, b)
+        if old[1] != new[1]:
+            print('  {:26} different decision: old {} new {}'.format(name, old[1], new[1]))
+        times = []
+        for func in (lambda: old_get_highlighted(a, b), lambda: get_highlighted(a, b)):
+            number, _ = timeit.Timer(func).autorange()
+            times.append(min(timeit.repeat(func, number=number, repeat=5)) / number * 1e3)
+        print('  {:26} old {:8.3f} ms  new {:8.3f} ms'.format(name, *times))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+#
+# irgramd: IRC-Telegram gateway
+# bench_filters.py: Microbenchmark of the filters of text received from Telegram
+#
+# Copyright (c) 2026 E. Bosch <presidev@AT@gmail.com>
+#
+# Use of this source code is governed by a MIT style license that
+# can be found in the LICENSE file included in this project.
+
+# Compares the emoji replacement and mentions of TelegramHandler.filters()
+# with the previous implementation (replace_mult and a regex per known
+# username), run from the top directory of irgramd:
+#   python3 tools/bench_filters.py [number of usernames]
+
+import os
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import emoji2emoticon as e
+from telegram import TelegramHandler
+
+# Previous implementation, as reference
+
+def old_replace_mult(line, emo):
+    # Without the ASCII shortcut
+    for utf_emo in emo:
+        if utf_emo in line:
+            line = line.replace(utf_emo, emo[utf_emo])
+    return line
+
+def old_replace_mentions(text, usernames, tg_username, high_ini='~', high_end='~'):
+    if '@' not in text:
+        return text
+    for user in usernames:
+        if user == tg_username or user not in text:
+            continue
+        text = re.sub(r'(?:(?<=^)|(?<= ))' + re.escape('@' + user) + r'(?=$| )',
+                      (high_ini + user + high_end).replace('\\', r'\\'), text)
+    return text
+
+def old_filters(text, usernames, tg_username):
+    return old_replace_mentions(old_replace_mult(text, e.emo), usernames, tg_username)
+
+def handler(usernames):
+    # Only what filters() uses
+    tg = TelegramHandler.__new__(TelegramHandler)
+    tg.high = '~~'
+    tg.mention = ': '
+    tg.rargs = {}
+    tg.tg_username = 'me'
+    tg.lookup_usernames = usernames
+    return tg
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    usernames = { 'user{}'.format(n) for n in range(count) }
+    tg = handler(usernames)
+    emoji = list(e.emo)
+    plain = 'Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod tempor incididunt ut labore'
+    cases = (
+              ('plain text (100 chars)', plain),
+              ('4 emoji', plain + ' ' + ' '.join(emoji[:4])),
+              ('non-ASCII, 2 emoji (2000 chars)', 'Привет, как дела? ' * 110 + emoji[0] + emoji[5]),
+              ('3 mentions', '@user1 ' + plain + ' @user20 and @user300'),
+              ('10 mentions + 10 emoji', ' '.join('@user{} {}'.format(n * 7, emoji[n]) for n in range(10)) + ' ' + plain),
+            )
+    print('Per call of filters, {} known usernames'.format(count))
+    for name, text in cases:
+        if old_filters(text, usernames, tg.tg_username) != tg.filters(text):
+            print('  {:32} different output'.format(name))
+        times = []
+        for func in (lambda: old_filters(text, usernames, tg.tg_username), lambda: tg.filters(text)):
+            number, _ = timeit.Timer(func).autorange()
+            times.append(min(timeit.repeat(func, number=number, repeat=7)) / number * 1e6)
+        print('  {:32} old {:8.2f} us  new {:8.2f} us'.format(name, *times))
+
+if __name__ == '__main__':
+    main()
@@ -8,19 +8,19 @@
 # can be found in the LICENSE file included in this project.
 
 import itertools
-import textwrap
 import re
 import datetime
 import zoneinfo
-import difflib
 import logging
 import hashlib
 import base64
+import ipaddress
 
 # Constants
 
 FILENAME_INVALID_CHARS = re.compile('[\0-\x1F/{}<>"\'\\|*&#%?\x7F]')
 SIMPLE_URL = re.compile('http(|s)://[^ ]+')
+LINE_CHUNKS = re.compile(' +|[^ ]+')
 
 from include import MAX_LINE
 
@@ -60,33 +60,67 @@ def set_replace(set, item, new_item):
         set.remove(item)
         set.add(new_item)
 
-def get_continued(items, mark, length):
-    # Add "continued" mark to lines, except last one
-    return (x + mark if n != length else x for n, x in enumerate(items, start=1))
-
 def split_lines(message):
     messages_limited = []
-    wr = textwrap.TextWrapper(width=MAX_LINE)
 
     # Split when Telegram original message has breaks
     messages = message.splitlines()
-    lm = len(messages)
-    if lm > 1:
-        # Add "continued line" mark (\) for lines that belong to the same message
-        # (split previously)
-        messages = get_continued(messages, ' \\', lm)
-    for m in messages:
-        wrapped = wr.wrap(text=m)
-        lw = len(wrapped)
-        if lw > 1:
+    last = len(messages) - 1
+    for n, m in enumerate(messages):
+        if last and n != last:
+            # Add "continued line" mark (\) for lines that belong to the same message
+            # (split previously)
+            m += ' \\'
+        wrapped = wrap_line(m.expandtabs(), MAX_LINE)
+        if len(wrapped) > 1:
             # Add double "continued line" mark (\\) for lines that belong to the same message
             # and have been wrapped to not exceed IRC limits
-            messages_limited += get_continued(wrapped, ' \\\\', lw)
+            for w in wrapped[:-1]:
+                messages_limited.append(w + ' \\\\')
+            messages_limited.append(wrapped[-1])
         else:
             messages_limited += wrapped
-    del wr
     return messages_limited
 
+def wrap_line(line, width):
+    # Wrap line in lines of width bytes (encoded in UTF-8) at most, splitting
+    # at spaces, words longer than width are broken. As textwrap: spaces at
+    # the start of the lines (except the first) and at the end are removed,
+    # only spaces gives no lines
+    def size(chunk):
+        return len(chunk) if chunk.isascii() else len(chunk.encode(errors='replace'))
+
+    lines = []
+    # Chunks (words and runs of spaces) with their sizes, in reverse order
+    chunks = [ (c, size(c)) for c in reversed(LINE_CHUNKS.findall(line)) ]
+    while chunks:
+        cur = []
+        cur_len = 0
+        if lines and chunks[-1][0][0] == ' ':
+            chunks.pop()
+        while chunks and cur_len + chunks[-1][1] <= width:
+            chunk, chunk_len = chunks.pop()
+            cur.append(chunk)
+            cur_len += chunk_len
+        if chunks and chunks[-1][1] > width:
+            # Break long word to fill the line, never in the middle of a character
+            chunk, chunk_len = chunks[-1]
+            space_left = width - cur_len
+            if chunk.isascii():
+                part = chunk[:space_left]
+            else:
+                part = chunk.encode(errors='replace')[:space_left].decode(errors='ignore')
+                if not part and not cur:
+                    part = chunk[0]
+            rest = chunk[len(part):]
+            cur.append(part)
+            chunks[-1] = (rest, size(rest))
+        if cur and cur[-1][:1] in (' ', ''):
+            cur.pop()
+        if cur:
+            lines.append(''.join(cur))
+    return lines
+
 def sanitize_filename(fn):
     def hexize(m):
         return '-{:x}-'.format(ord(m.group(0)))
@@ -188,35 +222,94 @@ def get_highlighted(a, b):
     else:
         al = a.split(' ')
         bl = b.split(' ')
-        diff = difflib.ndiff(al, bl)
-        ld = list(diff)
+        # Not highlighted if more than 3 words of b are not in a, that can
+        # be known when the diff exceeds this number of changes
+        max_d = len(al) + len(bl) - 2 * (bwl - 3)
+        diff = diff_words(al, bl, max_d)
         res = ''
-        d = ''
         eq = 0
 
-        for i in ld:
-            if i == '- ' or i[0] == '?':
-                continue
-            elif i == '  ' or i == '+ ':
-                res += ' '
-                continue
+        for op, word in diff or ():
+            if not word:
+                if op != '-':
+                    res += ' '
             # deletion of words
-            elif i[0] == '-':
-                res += '-{}- '.format(i[2:])
+            elif op == '-':
+                res += '-{}- '.format(word)
             # addition of words
-            elif i[0] == '+':
-                res += '+{}+ '.format(i[2:])
+            elif op == '+':
+                res += '+{}+ '.format(word)
             else:
-                res += '{} '.format(i[2:])
+                res += '{} '.format(word)
                 eq += 1
 
         delta_eq = bwl - eq
-        if delta_eq > 3:
+        if diff is None or delta_eq > 3:
             res = b
             highlighted = False
 
     return res, highlighted
 
+def diff_words(a, b, max_d):
+    # Myers diff of lists of words: list of (op, word), op is ' ' (equal),
+    # '-' (deleted) or '+' (added), None if there are more than max_d
+    # deleted and added words
+    n = len(a)
+    m = len(b)
+    if max_d < 0:
+        return None
+    offset = max_d + 1
+    v = [0] * (2 * offset + 1)
+    trace = []
+    for d in range(max_d + 1):
+        trace.append(v[:])
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and v[offset + k - 1] < v[offset + k + 1]):
+                x = v[offset + k + 1]
+            else:
+                x = v[offset + k - 1] + 1
+            y = x - k
+            while x < n and y < m and a[x] == b[y]:
+                x += 1
+                y += 1
+            v[offset + k] = x
+            if x >= n and y >= m:
+                break
+        else:
+            continue
+        break
+    else:
+        return None
+
+    # Path back from the end
+    ops = []
+    for d in range(d, 0, -1):
+        v = trace[d]
+        k = x - y
+        if k == -d or (k != d and v[offset + k - 1] < v[offset + k + 1]):
+            prev_k = k + 1
+        else:
+            prev_k = k - 1
+        prev_x = v[offset + prev_k]
+        prev_y = prev_x - prev_k
+        # Equal words after the deletion/addition
+        mid_x = prev_x if prev_k == k + 1 else prev_x + 1
+        while x > mid_x:
+            x -= 1
+            y -= 1
+            ops.append((' ', a[x]))
+        if prev_k == k + 1:
+            ops.append(('+', b[prev_y]))
+        else:
+            ops.append(('-', a[prev_x]))
+        x = prev_x
+        y = prev_y
+    while x > 0:
+        x -= 1
+        ops.append((' ', a[x]))
+    ops.reverse()
+    return ops
+
 def fix_braces(text):
     # Remove braces not closed, if the text was truncated
     if text.endswith(' {...'):
@@ -248,3 +341,10 @@ def hash_token(token, long):
     h = hashlib.md5(token).digest()
     b = base64.urlsafe_b64encode(h)[:long]
     return b.decode('ascii')
+
+def is_wildcard_address(address):
+    # Empty or unspecified (0.0.0.0, ::) listens on all interfaces
+    try:
+        return ipaddress.ip_address(address).is_unspecified
+    except ValueError:
+        return not address